@@ -24,6 +24,10 @@ class Dog(verifiable.VerifiableModel):
     color = verifiable.VerifiableCharField("color", max_length=30)
     breed = verifiable.VerifiableCharField("breed", max_length=30)
     
+class Cat(verifiable.VerifiableModel):
+    verifiableId = "Cat"
+    coat = verifiable.VerifiableCharField("coat", tree_class=verifiable.VerifiableBTree, max_length=30)
+    
 class BenchmarkModel(models.Model):
     field1 = models.CharField(max_length=30)
     field2 = models.CharField(max_length=30)
@@ -1,6 +1,6 @@
 from django.db import models, connection, transaction
 from django.db.models.query import insert_query
-from treerange import VerifiableTree
+from treerange import VerifiableTree, VerifiableBTree
 import hashlib  # Going to be used for hashing in the hash tree
 import hmac     # Going to be used for tuple macing
 import sqlite3  # Store model HMAC passwords and other data
@@ -264,6 +264,8 @@ class VerifiableQuerySet(models.query.QuerySet):
     can_be_filtered = True
     # Holds whether the current query is reversed (affects order_by queries)
     is_reversed = False
+    # Holds (field, min, max, include_min, include_max) when the query set is exactly a verified range of a tree-based field
+    _tree_range = None
     
     def __init__(self, password, can_be_filtered, is_reversed, model=None, query=None, using=None):
         self._data_password = password
@@ -282,7 +284,7 @@ class VerifiableQuerySet(models.query.QuerySet):
         """
         raise VerifiableError("Aggregate not supported")
 
-    # Returns the count of the current query set
+    # Returns the count of the current query set.  Counts of a verified range are taken from the tree.
     def count(self):
         """
         Performs a SELECT COUNT() and returns the number of records as an
@@ -291,8 +293,26 @@ class VerifiableQuerySet(models.query.QuerySet):
         If the QuerySet is already fully cached this simply returns the length
         of the cached results set to avoid multiple SELECT COUNT(*) calls.
         """
+        if self._tree_range is not None:
+            (field, minval, maxval, includeMin, includeMax) = self._tree_range
+            return field._tree.range_count(minval, maxval, includeMin, includeMax)
         return super(VerifiableQuerySet, self).count()
 
+    # Slices in tree order of a verified range are verified against the tree
+    def __getitem__(self, k):
+        """
+        Retrieves an item or slice from the set of results.
+        """
+        if isinstance(k, slice) and k.step is None and self._tree_range is not None:
+            (field, minval, maxval, includeMin, includeMax) = self._tree_range
+            if list(self.query.order_by) in ([field.name, "pk"], [field.name, "id"]) and self.query.standard_ordering:
+                querySet = super(VerifiableQuerySet, self).__getitem__(k)
+                rows = list(querySet)
+                if not field._tree.verify_slice(rows, minval, maxval, k.start, k.stop, includeMin, includeMax):
+                    raise VerifiableError("Data integrity check failed")
+                return querySet
+        return super(VerifiableQuerySet, self).__getitem__(k)
+
     # Gets a single row, need to validate
     def get(self, *args, **kwargs):
         """
@@ -795,6 +815,12 @@ class VerifiableQuerySet(models.query.QuerySet):
         querySet = super(VerifiableQuerySet, self).filter(*args, **kwargs)
         if vfield is not None:
             verifyQuerySet(querySet, self._data_password, verify, vfield, minval, maxval, includeMin, includeMax)
+            # The result is exactly the range if nothing else restricts it;
+            # B-trees keep no subtree sizes, so their ranges are counted
+            # and sliced as any other query set
+            if (verify and vfield._freshness and not args and len(kwargs) == 1 and not self.query.where.children and self.query.can_filter() and
+                    hasattr(vfield._tree, "range_count")):
+                querySet._tree_range = (vfield, minval, maxval, includeMin, includeMax)
         querySet.can_be_filtered = can_be_filtered
         return querySet
 
@@ -915,7 +941,9 @@ class VerifiableQuerySet(models.query.QuerySet):
         """
         Returns a new QuerySet instance with the ordering changed.
         """
-        return super(VerifiableQuerySet, self).order_by(*field_names)
+        querySet = super(VerifiableQuerySet, self).order_by(*field_names)
+        querySet._tree_range = self._tree_range
+        return querySet
 
     # Need to verify after distinct.
     def distinct(self, *field_names):
@@ -938,7 +966,9 @@ class VerifiableQuerySet(models.query.QuerySet):
         Reverses the ordering of the QuerySet.
         """
         self.is_reversed = not self.is_reversed
-        return super(VerifiableQuerySet, self).reverse()
+        querySet = super(VerifiableQuerySet, self).reverse()
+        querySet._tree_range = self._tree_range
+        return querySet
 
     # Returns an iterator over the rows.  Shouldn't affect validation
     def iterator(self):
@@ -1434,7 +1464,9 @@ class VerifiableField(models.Field):
     _data_password = None
     # Whether to use freshness or not (faster without)
     _freshness = True
-    # Holds the tree used in completeness with freshness
+    # Holds the tree used in completeness with freshness, made by the
+    # tree_class keyword argument of the field (VerifiableTree or
+    # VerifiableBTree, default VerifiableTree)
     _tree = None
     
     # Get the password for this field
@@ -1477,11 +1509,12 @@ class VerifiableCharField(models.CharField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableCharField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1497,11 +1530,12 @@ class VerifiableBooleanField(models.BooleanField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableBooleanField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1517,11 +1551,12 @@ class VerifiableDateField(models.DateField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableDateField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "NUMERIC", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "NUMERIC", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1537,11 +1572,12 @@ class VerifiableDateTimeField(models.DateTimeField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableDateTimeField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "NUMERIC", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "NUMERIC", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1557,11 +1593,12 @@ class VerifiableDecimalField(models.DecimalField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableDecimalField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "REAL", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "REAL", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1577,11 +1614,12 @@ class VerifiableEmailField(models.EmailField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableEmailField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1597,11 +1635,12 @@ class VerifiableFilePathField(models.FilePathField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableFilePathField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1617,11 +1656,12 @@ class VerifiableFloatField(models.FloatField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableFloatField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "REAL", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "REAL", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1637,11 +1677,12 @@ class VerifiableIntegerField(models.IntegerField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableIntegerField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1657,11 +1698,12 @@ class VerifiableBigIntegerField(models.BigIntegerField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableBigIntegerField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1677,11 +1719,12 @@ class VerifiableIPAddressField(models.IPAddressField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableIPAddressField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1697,11 +1740,12 @@ class VerifiableNullBooleanField(models.NullBooleanField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableNullBooleanField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1717,11 +1761,12 @@ class VerifiablePositiveIntegerField(models.PositiveIntegerField, VerifiableFiel
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiablePositiveIntegerField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1737,11 +1782,12 @@ class VerifiablePositiveSmallIntegerField(models.PositiveSmallIntegerField, Veri
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiablePositiveSmallIntegerField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1757,11 +1803,12 @@ class VerifiableSlugField(models.SlugField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableSlugField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1777,11 +1824,12 @@ class VerifiableSmallIntegerField(models.SmallIntegerField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableSmallIntegerField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "INTEGER", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1797,11 +1845,12 @@ class VerifiableTextField(models.TextField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableTextField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1817,11 +1866,12 @@ class VerifiableTimeField(models.TimeField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableTimeField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "NUMERIC", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "NUMERIC", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1837,11 +1887,12 @@ class VerifiableURLField(models.URLField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableURLField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
@@ -1857,11 +1908,12 @@ class VerifiableXMLField(models.XMLField, VerifiableField):
     def __init__(self, verifiableId, freshness=True, *args, **kwargs):
         # Place code here, which is excecuted the same
         # time the ``pre_init``-signal would be
+        tree_class = kwargs.pop('tree_class', VerifiableTree)
 
         # Call parent's ``init`` function
         super(VerifiableXMLField, self).__init__(*args,**kwargs)
         
-        self._tree = VerifiableTree(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
+        self._tree = tree_class(verifiableId, verifiableId, "TEXT", connection, sqlite3.connect('verifiable.sqlite'), transaction)
         self.verifiableId = verifiableId
         self._freshness = freshness
         self.getDataPassword()
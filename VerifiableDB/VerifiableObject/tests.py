@@ -1,9 +1,14 @@
 from django.test import TestCase
 from django.db import models
 from django.db import connection
-from TestObject.models import Person, Car, Dog, BenchmarkModel, BenchmarkIntegrity, BenchmarkCompleteness, BenchmarkCompletenessAndFreshness
+from django.conf import settings
+from TestObject.models import Person, Car, Dog, Cat, BenchmarkModel, BenchmarkIntegrity, BenchmarkCompleteness, BenchmarkCompletenessAndFreshness
 from VerifiableObject.models import VerifiableQuerySet, VerifiableEmptyQuerySet, VerifiableModel, VerifiableError
+from treerange import VerifiableTree, VerifiableBTree
+import setmac
+import treerange
 import random
+import sqlite3
 from datetime import datetime
 
 class ObjectIntegrityTestCase(TestCase):
@@ -456,6 +461,29 @@ class QuerySetCompletenessFreshnessTestCase(TestCase):
         finally:
             self.assertEquals(exception_thrown, True)
 
+    def test_filter_count(self):
+        """ Make sure that counts of a filtered range are right """
+        self.assertEquals(self.q.filter(color__range=("Black", "Brown")).count(), 2)
+        self.assertEquals(self.q.filter(color="Tan").count(), 0)
+
+    def test_filter_slice(self):
+        """ Make sure that slices of a range in field order are verified """
+        rows = self.q.filter(color__range=("Black", "White")).order_by("color", "pk")[1:3]
+        self.assertEquals(list(rows), [self.lab, self.terr])
+
+    def test_filter_single_select(self):
+        """ Make sure that a verified filter checks the rows it returns, reading them once """
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            connection.queries = []
+            rows = list(self.q.filter(color__range=("Black", "Brown")))
+            selects = [query for query in connection.queries if query["sql"].startswith("SELECT")]
+        finally:
+            settings.DEBUG = debug
+        self.assertEquals(set(row.pk for row in rows), set([self.lab.pk, self.bull.pk]))
+        self.assertEquals(len(selects), 1)
+
     def test_update(self):
         """ Make sure that update works """
         Dog.objects.get_query_set().filter(color="Brown").update(breed="Hotdog")
@@ -525,7 +553,290 @@ class QuerySetCompletenessFreshnessTestCase(TestCase):
         finally:
             self.assertEquals(exception_thrown, True)
 
+class BTreeFieldTestCase(TestCase):
+    def setUp(self):
+        # we have to do this to make that our auxiliary data structure is empty
+        t = Cat._meta.get_field("coat")._tree
+        c = t.conn.cursor()
+        c.execute("DELETE FROM %s WHERE 1" % t.table_name)
+        c.execute("DELETE FROM %s WHERE 1" % t.keys_table)
+        t.conn.commit()
+
+        t.root = None
+        t.cache = {}
+        t.counter = 0
+        t.bump_root()
+
+        self.tabby = Cat.objects.create(coat="Tabby")
+        self.black = Cat.objects.create(coat="Black")
+        self.white = Cat.objects.create(coat="White")
+        self.q = Cat.objects.get_query_set()
+
+    def test_tree_class(self):
+        """ Make sure that the field keeps its tree in the given class """
+        self.assertTrue(isinstance(Cat._meta.get_field("coat")._tree, VerifiableBTree))
+        self.assertTrue(isinstance(Dog._meta.get_field("color")._tree, VerifiableTree))
+
+    def test_filter(self):
+        """ Make sure that ranges are verified against the B-tree """
+        rows = self.q.filter(coat__range=("Black", "Tabby"))
+        self.assertEquals(set(row.pk for row in rows), set([self.tabby.pk, self.black.pk]))
+        self.assertEquals(rows.count(), 2)
+        self.assertEquals(list(self.q.filter(coat__gte="Black").order_by("coat")[2:]), [self.white])
+
+    def test_edit_and_delete(self):
+        """ Make sure that edits and deletes update the B-tree """
+        Cat.objects.get_query_set().filter(coat="Tabby").update(coat="Calico")
+        self.black.delete()
+        self.assertEquals(list(self.q.filter(coat__lte="Calico")), [self.tabby])
+        self.assertEquals(self.q.filter(coat="Black").count(), 0)
+
+    def test_verification_failure(self):
+        """ Make sure that a row missing from the B-tree fails verification """
+        c = connection.cursor()
+        c.execute("UPDATE %s SET coat = 'Tortie' WHERE id = %%s" % Cat._meta.db_table, [self.white.pk])
+        exception_thrown = False
+        try:
+            list(self.q.filter(coat__gte="Tabby"))
+        except VerifiableError:
+            exception_thrown = True
+        finally:
+            self.assertEquals(exception_thrown, True)
+
 count = 10
+class TreeRow(object):
+    """ Stand-in for a model instance, as seen by VerifiableTree """
+    def __init__(self, id, value):
+        self.id = id
+        self.value = value
+
+def in_range(value, rmin, rmax, include_rmin, include_rmax):
+    return ((rmin is None or value > rmin or (include_rmin and value == rmin)) and
+            (rmax is None or value < rmax or (include_rmax and value == rmax)))
+
+class ChunkFailure(Exception):
+    pass
+
+class ChunkFailingCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        if sql.startswith("DELETE") and "__format3 WHERE rowid" in sql and self.connection.chunks is not None:
+            if not self.connection.chunks:
+                raise ChunkFailure()
+            self.connection.chunks -= 1
+        return super(ChunkFailingCursor, self).execute(sql, *args)
+
+class ChunkFailingConnection(sqlite3.Connection):
+    """ Connection interrupting migrate_keyed once it moved the given number of chunks """
+    chunks = None
+
+    def cursor(self, factory=ChunkFailingCursor):
+        return super(ChunkFailingConnection, self).cursor(factory)
+
+class VerifiableTreeTestCase(TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+
+    def open_tree(self, type_name="INTEGER"):
+        return VerifiableTree("test", "value", type_name, None, self.conn, None)
+
+    def table_ids(self, tree):
+        return set(row_id for (row_id,) in self.conn.execute("SELECT row_id FROM %s" % tree.table_name))
+
+    def check_delete_range(self, tree, rows, rmin, rmax, include_rmin=True, include_rmax=True):
+        """ Deletes a range, checking the count, the table and the tree; returns the rows left """
+        left = [row for row in rows if not in_range(row.value, rmin, rmax, include_rmin, include_rmax)]
+        self.assertEquals(tree.delete_range(rmin, rmax, include_rmin, include_rmax), len(rows) - len(left))
+        self.assertEquals(self.table_ids(tree), set(row.id for row in left))
+        self.assertTrue(tree.verify(left, None, None))
+        self.assertTrue(self.open_tree(tree.type_name).verify(left, None, None))
+        return left
+
+    def test_delete_range(self):
+        """ Make sure that delete_range removes the rows of a range, with inclusive and exclusive bounds """
+        rows = [TreeRow(i, i % 10) for i in range(1, 101)]
+        tree = self.open_tree()
+        tree.build(rows)
+        rows = self.check_delete_range(tree, rows, 3, 5, False, False)
+        rows = self.check_delete_range(tree, rows, None, 1, True, False)
+        rows = self.check_delete_range(tree, rows, 7, None, True, True)
+        rows = self.check_delete_range(tree, rows, 2, 3)
+        rows = self.check_delete_range(tree, rows, 5, 5, False, True)
+        self.assertEquals(len(rows), 30)
+
+    def test_delete_range_chunks(self):
+        """ Make sure that delete_range deletes ranges of more rows than a statement takes """
+        rows = [TreeRow(i, i) for i in range(1, 2 * treerange.DELETE_CHUNK + 201)]
+        tree = self.open_tree()
+        tree.build(rows)
+        rows = self.check_delete_range(tree, rows, 100, 2 * treerange.DELETE_CHUNK + 150)
+        self.assertEquals(len(rows), 149)
+
+    def test_delete_range_mixed_types(self):
+        """ Make sure that delete_range follows the tree order, not SQL comparisons, on mixed type keys """
+        values = [None, -3, 0, 1, 2, 2.5, 3, 4.75, 10, u"", u"a", u"b", u"c", u"zz"]
+        rows = [TreeRow(i + 1, values[i % len(values)]) for i in range(70)]
+        tree = self.open_tree("")
+        tree.build(rows)
+        rows = self.check_delete_range(tree, rows, None, 0, True, False)
+        rows = self.check_delete_range(tree, rows, 2, u"b", False, False)
+        rows = self.check_delete_range(tree, rows, u"c", None)
+        self.assertEquals(set(row.value for row in rows), set([0, 1, 2, u"b"]))
+
+        # text affinity makes SQL compare the integer bound as text
+        rows = [TreeRow(i, unicode(i)) for i in range(1, 21)]
+        tree = VerifiableTree("text", "value", "TEXT", None, self.conn, None)
+        tree.build(rows)
+        self.assertEquals(tree.delete_range(None, 9), 0)
+        self.assertEquals(self.table_ids(tree), set(row.id for row in rows))
+        self.assertTrue(tree.verify(rows, None, None))
+
+    def test_range_count(self):
+        """ Make sure that range counts are verified, including the size of the whole tree """
+        rows = [TreeRow(i, i % 10) for i in range(1, 101)]
+        tree = self.open_tree()
+        tree.build(rows)
+        self.assertEquals(tree.range_count(None, None), 100)
+        self.assertEquals(tree.range_count(2, 4, True, False), 20)
+
+        self.conn.execute("UPDATE %s SET size = size + 1 WHERE row_id = ?" % tree.table_name, (tree.root.value,))
+        self.conn.commit()
+        tree = self.open_tree()
+        self.assertRaises(AssertionError, tree.range_count, None, None)
+
+        tree.root_hash = "00" * 32
+        self.assertRaises(AssertionError, tree.range_count, 2, 4)
+
+    def tree_state(self, tree):
+        """ Returns the rows of the tree table and the stored and in-memory root """
+        return (list(self.conn.execute("SELECT * FROM %s ORDER BY row_id" % tree.table_name)),
+                self.conn.execute("SELECT root_id, counter, root_hash FROM verifiable_trees WHERE table_name = ?", (tree.table_name,)).fetchone(),
+                tree.root_mac(), tree.counter)
+
+    def test_failed_operation_rolls_back(self):
+        """ Make sure that an operation raising leaves the table, root and counter as they were """
+        rows = [TreeRow(i, i % 10) for i in range(1, 51)]
+        tree = self.open_tree()
+        for row in rows:
+            tree.insert(row)
+        state = self.tree_state(tree)
+
+        try:
+            with tree.batch():
+                tree.insert(TreeRow(100, 3))
+                tree.delete(rows[7])
+                tree.delete_range(5, 6)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEquals(self.tree_state(tree), state)
+
+        # failing after the hooks ran, while writing the nodes back
+        def flush_writes():
+            raise ValueError()
+        tree.flush_writes = flush_writes
+        self.assertRaises(ValueError, tree.insert, TreeRow(101, 4))
+        del tree.flush_writes
+        self.assertEquals(self.tree_state(tree), state)
+        self.assertTrue(tree.verify(rows, None, None))
+        self.assertTrue(self.open_tree().verify(rows, None, None))
+
+        tree.insert(TreeRow(102, 4))
+        self.assertTrue(self.open_tree().verify(rows + [TreeRow(102, 4)], None, None))
+
+    def test_failed_rollback_keeps_error(self):
+        """ Make sure that the error of an operation is reported even if restoring the tree fails """
+        tree = self.open_tree()
+        tree.insert(TreeRow(1, 1))
+        def reload():
+            raise RuntimeError()
+        tree.reload = reload
+        try:
+            with tree.batch():
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertRaises(AssertionError, tree.check_root)
+        self.assertTrue(self.open_tree().verify([TreeRow(1, 1)], None, None))
+
+    def downgrade(self, tree, tree_format):
+        """ Rewrites the table of a tree in an older format, as older versions stored it """
+        nodes = list(self.conn.execute("SELECT left, right, row_id, row_key, mac, size FROM %s" % tree.table_name))
+        self.conn.execute("DROP TABLE %s" % tree.table_name)
+        self.conn.execute("""CREATE TABLE %s (left INTEGER, right INTEGER, row_id INTEGER, row_key %s, mac %s%s)""" %
+                          (tree.table_name, tree.type_name, "BLOB" if tree_format > 1 else "VARCHAR(100)",
+                           ", size INTEGER" if tree_format > 2 else ""))
+        root_mac = None
+        for left, right, row_id, row_key, mac, size in nodes:
+            mac = str(mac)
+            if tree_format < 3:
+                # no size tags before format 3
+                compressed = setmac.xor_hashes(setmac.extract_packed_MAC(tree.key1, mac, tree.backend), tree.size_tag(size))
+                mac = setmac.encrypt_packed_MAC(tree.key1, compressed, tree.backend)
+            if tree_format < 2:
+                mac = setmac.unpack_MAC(mac)
+            if row_id == tree.root.value:
+                root_mac = mac
+            values = [left, right, row_id, row_key, setmac.marshall_MAC(mac) if tree_format < 2 else sqlite3.Binary(mac)]
+            if tree_format > 2:
+                values.append(size)
+            self.conn.execute("INSERT INTO %s VALUES (%s)" % (tree.table_name, ", ".join("?" * len(values))), values)
+        if tree_format > 2:
+            self.conn.execute("CREATE INDEX %s__row_id ON %s (row_id)" % (tree.table_name, tree.table_name))
+        root_hash = setmac.kvhash(tree.key3, tree.counter, root_mac, tree.backend, tree.kvhash_version).encode("hex")
+        self.conn.execute("UPDATE verifiable_trees SET format = ?, root_hash = ? WHERE table_name = ?", (tree_format, root_hash, tree.table_name))
+        self.conn.commit()
+
+    def table_format(self, tree):
+        return self.conn.execute("SELECT format FROM verifiable_trees WHERE table_name = ?", (tree.table_name,)).fetchone()[0]
+
+    def test_migrations(self):
+        """ Make sure that trees in older table formats are upgraded and still verify """
+        rows = [TreeRow(i, i % 10) for i in range(1, 101)]
+        for tree_format in (1, 2, 3):
+            self.conn = sqlite3.connect(":memory:")
+            tree = self.open_tree()
+            tree.build(rows)
+            self.downgrade(tree, tree_format)
+
+            tree = self.open_tree()
+            self.assertEquals(self.table_format(tree), treerange.TREE_FORMAT)
+            keys = [column[1] for column in self.conn.execute("PRAGMA table_info(%s)" % tree.table_name) if column[5]]
+            self.assertEquals(keys, ["row_id"])
+            self.assertTrue(tree.verify(rows, None, None))
+            self.assertTrue(tree.verify([row for row in rows if 2 <= row.value <= 4], 2, 4))
+            self.assertEquals(tree.range_count(2, 4), 30)
+            self.assertFalse(tree.verify(rows[1:], None, None))
+
+            tree.insert(TreeRow(101, 5))
+            self.assertTrue(self.open_tree().verify(rows + [TreeRow(101, 5)], None, None))
+
+    def test_interrupted_migration(self):
+        """ Make sure that an interrupted migration to the keyed format resumes when the tree is opened again """
+        rows = [TreeRow(i, i % 10) for i in range(1, 301)]
+        self.conn = sqlite3.connect(":memory:", factory=ChunkFailingConnection)
+        tree = self.open_tree()
+        tree.build(rows)
+        root_mac = tree.root_mac()
+        self.downgrade(tree, 3)
+
+        chunk = treerange.MIGRATE_CHUNK
+        treerange.MIGRATE_CHUNK = 64
+        try:
+            self.conn.chunks = 1
+            self.assertRaises(ChunkFailure, self.open_tree)
+            self.assertEquals(self.table_format(tree), 3)
+            self.assertEquals(len(self.table_ids(tree)), 64)
+            self.conn.chunks = None
+            tree = self.open_tree()
+        finally:
+            treerange.MIGRATE_CHUNK = chunk
+
+        self.assertEquals(self.table_format(tree), treerange.TREE_FORMAT)
+        self.assertEquals(tree.root_mac(), root_mac)
+        self.assertEquals(self.table_ids(tree), set(row.id for row in rows))
+        self.assertFalse(self.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name LIKE '%__format3'").fetchone()[0])
+        self.assertTrue(tree.verify(rows, None, None))
+
 class BenchmarkModelTestCase(TestCase):
     def test_benchmark(self):
         print ""
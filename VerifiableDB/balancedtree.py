@@ -5,56 +5,445 @@
 # Author: Madars Virza <madars@mit.edu> (c) 2012
 #
 
+import contextlib
+
 class BalancedTree(object):
     """
     Implementation of a balanced binary search tree.
     
-    Current implementation: AVL tree from J.A. Storer's ``Introduction
-    to Data Structures and Algorithms''.
+    The balancing strategy is given by a policy: AVLPolicy (default,
+    the AVL tree from J.A. Storer's ``Introduction to Data Structures
+    and Algorithms''), WeightBalancedPolicy or TreapPolicy. Rotations
+    cost two update_hook calls each, so policies differ in write
+    amplification as well as depth.
     
     To ease augmenting after each batch of rebalancing updates to
     node.{left,right} a special method node.update_hook is called, so
-    augmented structure can be correctly populated.
+    augmented structure can be correctly populated. Inside a batch()
+    these calls are deferred to the end of the batch.
+
+    The paths from the root to the least and the greatest node are
+    kept as fingers, so inserting past either end (increasing keys
+    such as timestamps) reuses the path instead of walking down.
     """
-    def __init__(self, node_factory):
+    def __init__(self, node_factory, policy=None):
         """Initializes the tree to empty one."""
         self.root = None
         self.node_factory = node_factory
+        self.policy = policy or AVLPolicy()
+        # nodes awaiting update_hook while in a batch, None otherwise
+        self.dirty = None
+        # fingers[went_left] is the path from the root to the least
+        # (went_left) or greatest node, valid while it starts at root
+        self.fingers = {}
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Defers update_hook calls to the end of the with block: the
+        operations inside only mark the nodes they touch dirty, and
+        when the outermost batch ends update_hook is called once per
+        dirty node, children before parents. Augmented data is stale
+        inside the block, and stays stale if the block raises: the
+        tree may be half rebalanced then, so no hook is called."""
+        if self.dirty is not None:
+            yield self
+            return
+
+        self.dirty = set()
+        try:
+            yield self
+        except:
+            self.dirty = None
+            raise
+        dirty, self.dirty = self.dirty, None
+        self.run_hooks(dirty)
 
     def insert(self, key, value):
-        """Inserts a key/value pair in the tree."""
+        """Inserts a key/value pair in the tree.
+
+        Walks down from the root keeping the path in an explicit
+        stack, then rebalances bottom-up. update_hook is called exactly
+        once on every node whose subtree changed, children before
+        parents. Nodes going past the least or greatest key take the
+        path of the finger, without visiting it."""
         node = self.node_factory(key, value)
 
-        if self.root:
-            self.root = self.root.insert(node)
-        else:
+        if not self.root:
             self.root = node
+            return
+
+        # path holds (node, True iff we went left from node) pairs
+        path = self.finger_path(node.key)
+        if path is None:
+            path = []
+            t = self.root
+            while t:
+                t.visit_hook()
+                went_left = node.key < t.key
+                path.append((t, went_left))
+                t = t.left if went_left else t.right
+
+        self.set_child(path, len(path), node)
+        self.rebalance_path(path)
+
+        directions = set(went_left for t, went_left in path)
+        if len(directions) == 1:
+            # node is the new least or greatest one; rotations on its
+            # side only change the other finger by moving the root
+            went_left = directions.pop()
+            self.fingers[went_left] = self.spine(went_left)
+        else:
+            self.fingers.clear()
+
+    def finger_path(self, key):
+        """Returns the insertion path of key taken from a finger, if the
+        key goes past the least or greatest node, otherwise None."""
+        for went_left, spine in self.fingers.iteritems():
+            if spine[0] is self.root and (key < spine[-1].key) == went_left:
+                return [(t, went_left) for t in spine]
+        return None
+
+    def spine(self, went_left):
+        """Returns the path from the root always going left (or right).
+        Only used after inserts along it, so its nodes are loaded."""
+        spine = []
+        t = self.root
+        while t:
+            spine.append(t)
+            t = t.left if went_left else t.right
+        return spine
     
     def delete(self, key):
-        """Deletes the specified node from tree and returns it."""
+        """Deletes the specified node from tree and returns it.
+
+        Same as insert, the path is kept in an explicit stack and
+        update_hook is called once per touched node, children before
+        parents."""
         assert(self.root)
-        self.root, node = self.root.delete(key)
-        return node
+        self.fingers.clear()
+
+        path = []
+        t = self.root
+        while True:
+            assert(t)
+            t.visit_hook()
+            if key < t.key:
+                path.append((t, True))
+                t = t.left
+            elif t.key < key:
+                path.append((t, False))
+                t = t.right
+            else:
+                break
+
+        if t.left and t.right:
+            # replace t by the least node of its right subtree
+            index = len(path)
+            path.append((t, False))
+            s = t.right
+            s.visit_hook()
+            while s.left:
+                path.append((s, True))
+                s = s.left
+                s.visit_hook()
+
+            self.set_child(path, len(path), s.right)
+            s.left, s.right = t.left, t.right
+            path[index] = (s, False)
+            self.set_child(path, index, s)
+        else:
+            self.set_child(path, len(path), t.left if t.left else t.right)
+
+        t.left = None
+        t.right = None
+        self.rebalance_path(path)
+        return t
+
+    def set_child(self, path, i, node):
+        """Makes node the child of path[i-1], in the direction taken
+        there, or the root if i is 0."""
+        if i == 0:
+            self.root = node
+            return
+        parent, went_left = path[i - 1]
+        if went_left:
+            parent.left = node
+        else:
+            parent.right = node
+
+    def rebalance_path(self, path):
+        """Rebalances all nodes on path, bottom-up, and then calls
+        update_hook on every node whose subtree changed, or marks them
+        dirty in a batch."""
+        touched = set()
+        for i in xrange(len(path) - 1, -1, -1):
+            self.set_child(path, i, self.policy.balance(path[i][0], touched))
+        if self.dirty is not None:
+            self.dirty |= touched
+        else:
+            self.run_hooks(touched)
+
+    def run_hooks(self, touched, roots=None):
+        """Calls update_hook on every node of touched, children before
+        parents. Parents of touched nodes must be touched too, so the
+        touched nodes are exactly the ones found by a post-order walk
+        from the root (or the given roots) that does not leave
+        touched."""
+        stack = [(root, False) for root in (roots if roots is not None else [self.root])
+                 if root and root in touched]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                node.update_hook()
+                continue
+            stack.append((node, True))
+            for child in (node.left, node.right):
+                if child and child in touched:
+                    stack.append((child, False))
+
+    def split(self, key):
+        """Splits the tree at key and returns the roots (left, right)
+        of two balanced trees, holding the nodes with keys less than
+        key and the rest. The tree itself is left empty.
+
+        update_hook is called on the O(log n) nodes on the path to key,
+        children before parents (in a batch they are marked dirty, and
+        only those still reachable from the root at the end of the
+        batch are hooked)."""
+        self.fingers.clear()
+        touched = set()
+        left, right = self.split_subtree(self.root, key, touched)
+        self.root = None
+        self.mark_touched(touched, [left, right])
+        return left, right
+
+    def join(self, left, right):
+        """Makes the tree the join of the balanced trees rooted at left
+        and right, where all keys of left are less than those of right.
+        Takes O(log n) time and update_hook calls, see split."""
+        self.fingers.clear()
+        touched = set()
+        if not left or not right:
+            self.root = left or right
+            return
+        right, node = self.pop_min(right, touched)
+        self.root = self.join_subtrees(left, node, right, touched)
+        self.mark_touched(touched, [self.root])
+
+    def mark_touched(self, touched, roots):
+        """Calls update_hook on touched below roots, or marks them dirty
+        in a batch."""
+        if self.dirty is not None:
+            self.dirty |= touched
+        else:
+            self.run_hooks(touched, roots)
+
+    def split_subtree(self, t, key, touched):
+        """Splits the subtree of t at key, see split."""
+        if not t:
+            return None, None
+        t.visit_hook()
+        left, right = t.left, t.right
+        if t.key < key:
+            l, r = self.split_subtree(right, key, touched)
+            return self.join_subtrees(left, t, l, touched), r
+        else:
+            l, r = self.split_subtree(left, key, touched)
+            return l, self.join_subtrees(r, t, right, touched)
+
+    def join_subtrees(self, left, node, right, touched):
+        """Joins the subtrees left and right, with node going between
+        them, and returns the new root."""
+        return self.policy.join(left, node, right, touched)
+
+    def pop_min(self, t, touched):
+        """Removes the least node of the subtree of t, returning the new
+        root of the subtree and the node."""
+        t.visit_hook()
+        if not t.left:
+            node, rest = t, t.right
+            node.right = None
+            return rest, node
+        t.left, node = self.pop_min(t.left, touched)
+        return self.policy.balance(t, touched), node
+
+    def build_from_sorted(self, items, node_factory=None):
+        """Fills an empty tree with the key/value pairs of items, which
+        must be sorted by key, in O(n) time. Nodes are made by
+        node_factory (default: the tree's) and linked into a perfectly
+        balanced tree; update_hook is called once per node, children
+        before parents."""
+        assert(not self.root)
+        self.fingers.clear()
+        node_factory = node_factory or self.node_factory
+        nodes = [node_factory(key, value) for key, value in items]
+        for a, b in zip(nodes, nodes[1:]):
+            assert(not (b.key < a.key))
+
+        def link(lo, hi):
+            """Links nodes[lo:hi] and returns the root."""
+            if lo >= hi:
+                return None
+            mid = (lo + hi) // 2
+            node = nodes[mid]
+            node.left = link(lo, mid)
+            node.right = link(mid + 1, hi)
+            node.update_height()
+            node.update_hook()
+            return node
+
+        self.root = link(0, len(nodes))
 
     def find(self, key):
         """Returns the specified node from tree or None if the
         node is not present."""
-        if root:
-            return self.root.find(key)
+        t = self.root
+        while t:
+            t.visit_hook()
+            if key < t.key:
+                t = t.left
+            elif t.key < key:
+                t = t.right
+            else:
+                return t
+        return None
+
+class AVLPolicy(object):
+    """Keeps the heights of sibling subtrees within one of each other:
+    the shallowest trees, at the cost of frequent rotations."""
+
+    def balance(self, node, touched):
+        """Rebalances the subtree of node after a single insert or
+        delete below it, and returns the new root. Nodes needing
+        update_hook are added to touched, see BalancedTreeNode.balance."""
+        return node.balance(touched)
+
+    def join(self, left, node, right, touched):
+        """Joins the subtrees left and right, with node going between
+        them, and returns the new root. Walks down the taller subtree
+        to the height of the other one, so it takes time proportional
+        to their difference in height."""
+        lheight = left.height if left else 0
+        rheight = right.height if right else 0
+        if lheight > rheight + 1:
+            left.right = self.join(left.right, node, right, touched)
+            return self.balance(left, touched)
+        elif rheight > lheight + 1:
+            right.left = self.join(left, node, right.left, touched)
+            return self.balance(right, touched)
+        node.left, node.right = left, right
+        node.update_height()
+        node.hook(touched)
+        return node
+
+class WeightBalancedPolicy(AVLPolicy):
+    """Keeps the weights (node counts plus one) of sibling subtrees
+    within a factor delta of each other, using the single and double
+    rotations of Adams' trees with the (delta, gamma) = (3, 2) shown
+    correct by Hirai and Yamamoto. Trees are somewhat deeper than AVL
+    trees, but rotations are rarer."""
+    delta = 3
+    gamma = 2
+
+    def weight(self, node):
+        return node.weight + 1 if node else 1
+
+    def balance(self, node, touched):
+        left, right = self.weight(node.left), self.weight(node.right)
+        if right > self.delta * left:
+            inner, outer = self.weight(node.right.left), self.weight(node.right.right)
+            if inner >= self.gamma * outer:
+                node.right = node.right.rotate_right(touched)
+            return node.rotate_left(touched)
+        elif left > self.delta * right:
+            inner, outer = self.weight(node.left.right), self.weight(node.left.left)
+            if inner >= self.gamma * outer:
+                node.left = node.left.rotate_left(touched)
+            return node.rotate_right(touched)
+        node.update_height()
+        node.hook(touched)
+        return node
+
+    def join(self, left, node, right, touched):
+        """Joins the subtrees left and right, with node going between
+        them, and returns the new root. Walks down the heavier subtree
+        until the weights are balanced."""
+        if self.weight(left) > self.delta * self.weight(right):
+            left.right = self.join(left.right, node, right, touched)
+            return self.balance(left, touched)
+        elif self.weight(right) > self.delta * self.weight(left):
+            right.left = self.join(left, node, right.left, touched)
+            return self.balance(right, touched)
+        node.left, node.right = left, right
+        node.update_height()
+        node.hook(touched)
+        return node
+
+class TreapPolicy(AVLPolicy):
+    """Keeps nodes in heap order of a priority derived from their key,
+    which makes the tree a random one of expected O(log n) depth with
+    fewer than two rotations per insert or delete on average. The
+    priority is a hash of the key, so nothing is stored for it.
+
+    Heap order is relaxed to a goal rather than an invariant: only
+    the nodes on the path of an update are sifted, so a tree built by
+    build_from_sorted or balanced under another policy stays valid and
+    only drifts towards heap order as it is updated."""
+    MASK = (1 << 64) - 1
+
+    def priority(self, node):
+        """Returns the priority of node: the splitmix64 finalizer of
+        the key's hash, as hashes of consecutive integers are
+        consecutive."""
+        h = hash(node.key) & self.MASK
+        h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & self.MASK
+        h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & self.MASK
+        return h ^ (h >> 31)
+
+    def balance(self, node, touched):
+        """Sifts node down below its children of greater priority."""
+        priority = self.priority(node)
+        left = self.priority(node.left) if node.left else -1
+        right = self.priority(node.right) if node.right else -1
+        if max(left, right) <= priority:
+            node.update_height()
+            node.hook(touched)
+            return node
+
+        if left > right:
+            root = node.rotate_right(touched)
+            root.right = self.balance(node, touched)
         else:
-            return None
+            root = node.rotate_left(touched)
+            root.left = self.balance(node, touched)
+        root.update_height()
+        root.hook(touched)
+        return root
+
+    def join(self, left, node, right, touched):
+        """Joins the subtrees left and right, with node going between
+        them, and returns the new root: node is put on top of them and
+        sifted down."""
+        node.left, node.right = left, right
+        return self.balance(node, touched)
 
 class BalancedTreeNode(object):
+    # no per-instance __dict__, as trees may keep millions of nodes
+    # cached; subclasses should declare __slots__ for their own fields
+    __slots__ = ("key", "value", "left", "right", "height", "weight")
+
     def __init__(self, key, value):
         """Initializes node. Doesn't call update_hook."""
         self.key, self.value = key, value
         self.left, self.right = None, None
         self.height = 1
+        self.weight = 1
 
     def visit_hook(self):
-        """A hook function called on every recursive call of
-        find/insert/delete just after entering the node. Not called on
-        insert."""
+        """A hook function called by the tree's find/insert/delete on
+        every node of the path from the root, just after reaching it.
+        Not called on the nodes of a finger path, see
+        BalancedTree.insert."""
         pass
 
     def update_hook(self):
@@ -67,71 +456,6 @@ class BalancedTreeNode(object):
         insert."""
         pass
 
-    def find(self, key):
-        """Retrieves the specified node from the tree."""
-        self.visit_hook()
-
-        if node.key == self.key:
-            return self
-        elif node.key < self.key:
-            return self.left.find(key)
-        else:
-            return self.right.find(key)
-
-    def insert(self, node):
-        """Inserts the specified node into this subtree."""
-        self.visit_hook()
-        
-        if node.key < self.key:
-            self.left = self.left.insert(node) if self.left else node
-        else:
-            self.right = self.right.insert(node) if self.right else node
-        return self.balance()
-
-    def delete(self, key):
-        """Deletes the item with the specified key from this subtree
-        and returns pair (newroot, deleted_item)"""
-        self.visit_hook()
-        
-        if key < self.key:
-            assert(self.left)
-            self.left, node = self.left.delete(key)
-            return (self.balance(), node)
-        elif self.key < key:
-            assert(self.right)
-            self.right, node = self.right.delete(key)
-            return (self.balance(), node)
-        else:
-            # in either of two cases below we return a balanced tree
-            if not self.left:
-                newroot = self.right
-                self.right = None
-                
-                return (newroot, self)
-            if not self.right:
-                newroot = self.left
-                self.left = None
-
-                return (newroot, self)
-
-            # |left.height-right.height| <= 1 if we remove min from
-            # right, then |left.height-right'.height| <=2 and
-            # balancing conditions are met. So balance()'s on the way
-            # to root will be able to properly rebalance the tree.
-
-            upper_bound = self.right
-            
-            while upper_bound.left:
-                upper_bound = upper_bound.left
-                
-            newright, newself = self.right.delete(upper_bound.key)
-            newself.left = self.left
-            newself.right = newright
-            
-            self.left = None
-            self.right = None
-            return (newself.balance(), self)
-
     def lheight(self):
         """Returns height of left subtree."""
         return self.left.height if self.left else 0
@@ -141,16 +465,20 @@ class BalancedTreeNode(object):
         return self.right.height if self.right else 0
 
     def update_height(self):
-        """Recomputes height."""
-        self.height = 1 + max(self.lheight(), self.rheight())
+        """Recomputes height and weight (the number of nodes of the
+        subtree), which balancing policies rely on."""
+        left, right = self.left, self.right
+        self.height = 1 + max(left.height if left else 0, right.height if right else 0)
+        self.weight = 1 + (left.weight if left else 0) + (right.weight if right else 0)
 
-    def balance(self):
+    def balance(self, touched=None):
         """Balances tree rooted at this node, assuming that height
         difference for the root is at most +-2 and that height
         difference for all descendants are +-1. Returns the new root.
         
         Calls update_hook if no balancing is necessary, because balance
-        will be used recursively in insert/delete."""
+        will be used recursively in insert/delete. If touched is given,
+        nodes that need update_hook are added to it instead."""
 
         # pretty ASCII diagrams adapted from Storer's book
         
@@ -171,7 +499,7 @@ class BalancedTreeNode(object):
                 #  |           |             | |
                 # in each tree one is h and one is h or h-1
                 #
-                self.left = self.left.rotate_left()
+                self.left = self.left.rotate_left(touched)
             #
             # now b is left-heavy:
             #
@@ -187,21 +515,29 @@ class BalancedTreeNode(object):
             # If subcase applied then X,Y is h+1,h or h+1,h-1 (in this
             # order); the balance is still preserved.
             #
-            return self.rotate_right()
+            return self.rotate_right(touched)
         elif self.rheight() > 1 + self.lheight():
             # (symmetric; drawing diagrams is too tedious)
             if self.right.rheight() < self.right.lheight():
-                self.right = self.right.rotate_right()
-            return self.rotate_left()
+                self.right = self.right.rotate_right(touched)
+            return self.rotate_left(touched)
         else:
             # both are called in rotation
             self.update_height()
-            self.update_hook()
+            self.hook(touched)
             return self
 
-    def rotate_left(self):
+    def hook(self, touched=None):
+        """Calls update_hook, or adds node to touched if given."""
+        if touched is None:
+            self.update_hook()
+        else:
+            touched.add(self)
+
+    def rotate_left(self, touched=None):
         """
-        Performs a left rotation and returns the new root:
+        Performs a left rotation and returns the new root (see balance
+        for touched):
         
            a             b
           / \           / \
@@ -213,13 +549,14 @@ class BalancedTreeNode(object):
         a, b = self, self.right
         a.right, b.left = b.left, a
 
-        a.update_height(); a.update_hook()
-        b.update_height(); b.update_hook()
+        a.update_height(); a.hook(touched)
+        b.update_height(); b.hook(touched)
         return b
 
-    def rotate_right(self):
+    def rotate_right(self, touched=None):
         """
-        Performs a right rotation and returns the new root:
+        Performs a right rotation and returns the new root (see balance
+        for touched):
         
             b            a
            / \          / \
@@ -231,14 +568,18 @@ class BalancedTreeNode(object):
         a, b = self.left, self
         a.right, b.left = b, a.right
 
-        b.update_height(); b.update_hook()
-        a.update_height(); a.update_hook()
+        b.update_height(); b.hook(touched)
+        a.update_height(); a.hook(touched)
         return a
 
 def xor_test():
     """Performs a simple XOR-based test."""
+    import math
     import random
     
+    hooked = []
+    visited = []
+
     class XORTestNode(BalancedTreeNode):
         """Test for child hooks: maintains XOR of all numbers in this subtree."""
         def __init__(self, key, value):
@@ -247,9 +588,13 @@ def xor_test():
             super(XORTestNode, self).__init__(key, value)
             self.xor = value
             self.size = 1
+
+        def visit_hook(self):
+            visited.append(self)
         
         def update_hook(self):
             """Updates node, by recalculating size and XOR."""
+            hooked.append(self)
             self.xor = self.value
             self.size = 1
             if self.left:
@@ -281,10 +626,26 @@ def xor_test():
         
         t.insert(k, r)
         allxor ^= r
+        assert(len(set(hooked)) == len(hooked))
+        del hooked[:]
 
     assert(t.root.size == N)
     print "Built a tree with height=%d, size=%d" % (t.root.height, t.root.size)
     
+    # delete a random half first, which exercises deletion of nodes
+    # with two children, then the rest in increasing order
+    for k in random.sample(arr, N // 2):
+        node = t.delete(k)
+        assert(node.key == k)
+        assert(len(set(hooked)) == len(hooked))
+        assert(node not in hooked)
+        del hooked[:]
+        allxor ^= node.value
+        N -= 1
+        assert(t.root.size == N and t.root.xor == allxor)
+        arr.remove(k)
+    assert(t.root.height <= 1.45 * math.log(N + 2, 2))
+
     arr2 = []
     while t.root:
         assert(allxor == t.root.xor)
@@ -294,6 +655,9 @@ def xor_test():
         while m.left:
             m = m.left
         node = t.delete(m.key)
+        assert(len(set(hooked)) == len(hooked))
+        assert(node not in hooked)
+        del hooked[:]
         
         arr2.append(node.key)
         allxor ^= node.value
@@ -301,6 +665,150 @@ def xor_test():
 
     assert(sorted(arr) == arr2)
     
+    for n in [0, 1, 2, 3, 100, 1000]:
+        items = sorted((random.randint(0, n), random.randint(0, 1<<31)) for i in xrange(n))
+        t = BalancedTree(XORTestNode)
+        t.build_from_sorted(items)
+        assert(len(set(hooked)) == len(hooked) == n)
+        del hooked[:]
+        if n:
+            assert(t.root.size == n)
+            assert(t.root.xor == reduce(lambda a, b: a ^ b, [v for k, v in items]))
+            assert((1 << (t.root.height - 1)) <= n < (1 << t.root.height))
+        for k, v in items:
+            assert(t.find(k).key == k)
+        t.insert(n // 2, 1)
+        t.delete(n // 2)
+        del hooked[:]
+
+    # split and join
+    def check(node):
+        """Checks AVL invariants and augmentation; returns the keys."""
+        if not node:
+            return []
+        left, right = check(node.left), check(node.right)
+        assert(abs(node.lheight() - node.rheight()) <= 1)
+        assert(node.height == 1 + max(node.lheight(), node.rheight()))
+        assert(node.size == 1 + len(left) + len(right))
+        assert(node.xor == reduce(lambda a, b: a ^ b, [node.value] + [k for k in left + right]))
+        return left + [node.key] + right
+
+    for n in [0, 1, 2, 10, 1000]:
+        for cut in [-1, 0, n // 3, n // 2, n, n + 1]:
+            t = BalancedTree(XORTestNode)
+            t.build_from_sorted((k, k) for k in xrange(n))
+            del hooked[:]
+            left, right = t.split(cut)
+            assert(check(left) == range(min(max(cut, 0), n)))
+            assert(check(right) == range(max(cut, 0), n))
+            assert(len(set(hooked)) == len(hooked) <= 60)
+            del hooked[:]
+            t.join(left, right)
+            assert(check(t.root) == range(n))
+            assert(len(hooked) <= 40)
+            del hooked[:]
+
+    # cut a range out and join the rest
+    t = BalancedTree(XORTestNode)
+    for k in random.sample(xrange(2000), 2000):
+        t.insert(k, k)
+    del hooked[:]
+    with t.batch():
+        left, rest = t.split(500)
+        t.root = rest
+        middle, right = t.split(1500)
+        t.join(left, right)
+    assert(check(t.root) == range(500) + range(1500, 2000))
+    assert(len(set(hooked)) == len(hooked) <= 100)
+    del hooked[:]
+
+    # increasing and decreasing keys are inserted along the fingers
+    t = BalancedTree(XORTestNode)
+    del visited[:]
+    for k in xrange(1000, 2000):
+        t.insert(k, k)
+    for k in xrange(999, -1, -1):
+        t.insert(k, k)
+    assert(len(visited) < 20)
+    assert(check(t.root) == range(2000))
+    keys = range(2000)
+    for k in random.sample(xrange(1, 2000), 100):
+        t.delete(k)
+        t.insert(k, k)
+        if k % 2:
+            t.insert(2000 + k, 2000 + k)
+            t.insert(-k, -k)
+            t.delete(2000 + k)
+            keys.append(-k)
+    del visited[:]
+    with t.batch():
+        for k in xrange(4000, 5000):
+            t.insert(k, k)
+    assert(len(visited) < 20)
+    assert(check(t.root) == sorted(keys) + range(4000, 5000))
+    del hooked[:], visited[:]
+
+    # in a batch each dirty node is hooked once, at the end
+    t = BalancedTree(XORTestNode)
+    t.build_from_sorted((k, k) for k in xrange(0, 1000, 2))
+    del hooked[:]
+    with t.batch():
+        for k in xrange(1, 1000, 2):
+            t.insert(k, k)
+        for k in xrange(0, 1000, 4):
+            t.delete(k)
+        with t.batch():
+            t.insert(1000, 1000)
+        assert(not hooked)
+    assert(len(set(hooked)) == len(hooked))
+    assert(len(hooked) < 1000)
+    keys = [k for k in xrange(1000) if k % 4] + [1000]
+    assert(t.root.size == len(keys))
+    assert(t.root.xor == reduce(lambda a, b: a ^ b, keys))
+    del hooked[:]
+
+    # the other balancing policies
+    def check_policy(node, policy):
+        """Checks the invariants of policy and augmentation; returns
+        the keys."""
+        if not node:
+            return []
+        left, right = check_policy(node.left, policy), check_policy(node.right, policy)
+        assert(node.weight == 1 + len(left) + len(right))
+        assert(node.size == node.weight)
+        assert(node.xor == reduce(lambda a, b: a ^ b, [node.value] + [k for k in left + right]))
+        if isinstance(policy, WeightBalancedPolicy):
+            assert(policy.weight(node.left) <= policy.delta * policy.weight(node.right))
+            assert(policy.weight(node.right) <= policy.delta * policy.weight(node.left))
+        elif isinstance(policy, TreapPolicy):
+            for child in (node.left, node.right):
+                assert(not child or policy.priority(child) <= policy.priority(node))
+        return left + [node.key] + right
+
+    for policy in [WeightBalancedPolicy(), TreapPolicy()]:
+        t = BalancedTree(XORTestNode, policy)
+        keys = random.sample(xrange(1 << 20), 2000) + range(1000)
+        for k in keys:
+            t.insert(k, k)
+            assert(len(set(hooked)) == len(hooked))
+            del hooked[:]
+        assert(check_policy(t.root, policy) == sorted(keys))
+        for k in keys[::2]:
+            t.delete(k)
+            assert(len(set(hooked)) == len(hooked))
+            del hooked[:]
+        keys = sorted(keys[1::2])
+        assert(check_policy(t.root, policy) == keys)
+        assert(t.root.height <= 3 * math.log(len(keys), 2))
+
+        cut = keys[len(keys) // 3]
+        left, right = t.split(cut)
+        assert(check_policy(left, policy) + check_policy(right, policy) == keys)
+        assert(check_policy(right, policy)[0] == cut)
+        t.join(left, right)
+        assert(check_policy(t.root, policy) == keys)
+        del hooked[:]
+
     print "All tests passed"
 
 if __name__ == '__main__':
@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+#
+# Micro-benchmarks for setmac and treerange. Run as
+#
+#   python benchmark.py [name ...]
+#
+# to run the named benchmarks (all of them by default).
+#
+
+import hmac
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import balancedtree
+import setmac
+import treebench
+import treerange
+
+class Row(object):
+    """Stand-in for a model instance, as seen by VerifiableTree."""
+    def __init__(self, id, value):
+        self.id, self.value = id, value
+
+def timed(fn, repeat=3):
+    """Returns the best wall-clock time of repeat calls of fn."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def make_tree(n, conn=None, backend=None):
+    """Returns an in-memory VerifiableTree over n rows with random
+    integer values, and the rows themselves."""
+    conn = conn or sqlite3.connect(":memory:")
+    tree = treerange.VerifiableTree("bench", "value", "INTEGER", None, conn, None, backend)
+    rows = [Row(i, random.randint(1, n)) for i in xrange(1, n + 1)]
+    for row in rows:
+        tree.insert(row)
+    return tree, rows
+
+def uncached_H(key, s, backend=setmac.DEFAULT_BACKEND):
+    """setmac.H without the keyed HMAC cache (HMAC-SHA256 only)."""
+    return hmac.new(str(key), str(s), setmac.HASH_FN).digest()
+
+def bench_hmac_cache(n=20000, tree_size=2000, queries=200):
+    """Compares setmac.H with and without the keyed HMAC cache on
+    compress and range_compressed_MAC."""
+    key = setmac.rand().encode("hex")
+    d = dict((i, "value-%d" % i) for i in xrange(n))
+    tree, rows = make_tree(tree_size)
+    bounds = [sorted(random.randint(1, tree_size) for j in xrange(2)) for i in xrange(queries)]
+
+    def ranges():
+        for rmin, rmax in bounds:
+            tree.range_compressed_MAC(rmin, rmax)
+
+    cached_H = setmac.H
+    results = {}
+    for name, H in [("uncached", uncached_H), ("cached", cached_H)]:
+        setmac.H = H
+        try:
+            results[name] = (timed(lambda: setmac.compress(key, d)), timed(ranges))
+        finally:
+            setmac.H = cached_H
+
+    print "compress of %d pairs:" % n
+    for name in ["uncached", "cached"]:
+        print "    %-8s %.3fs" % (name, results[name][0])
+    print "%d range_compressed_MAC calls on %d rows:" % (queries, tree_size)
+    for name in ["uncached", "cached"]:
+        print "    %-8s %.3fs" % (name, results[name][1])
+
+def bench_backends(n=20000, tree_size=1000, queries=200):
+    """Compares the available setmac digest backends on compress, on
+    building a tree (which is dominated by update_hook) and on
+    verifying ranges of a tree."""
+    key = setmac.rand().encode("hex")
+    d = dict((i, "value-%d" % i) for i in xrange(n))
+
+    print "%-12s %12s %12s %12s" % ("backend", "compress", "build", "verify")
+    for backend in sorted(setmac.BACKENDS):
+        t_compress = timed(lambda: setmac.compress(key, d, backend=backend))
+
+        start = time.time()
+        tree, rows = make_tree(tree_size, backend=backend)
+        t_build = time.time() - start
+
+        bounds = [sorted(random.randint(1, tree_size) for j in xrange(2)) for i in xrange(queries)]
+        def ranges():
+            for rmin, rmax in bounds:
+                subset = [row for row in rows if rmin <= row.value <= rmax]
+                assert(tree.verify(subset, rmin, rmax))
+        t_verify = timed(ranges)
+
+        print "%-12s %11.3fs %11.3fs %11.3fs" % (backend, t_compress, t_build, t_verify)
+    print "(compress of %d pairs, build of %d rows, %d range verifications)" % (n, tree_size, queries)
+
+def bench_nonce_pool(tree_size=2000, nonces=100000):
+    """Times taking nonces, alone and while building a tree, with
+    nonces taken directly from os.urandom and from a setmac.NoncePool,
+    and counts the system calls made for them: each os.urandom call
+    reads /dev/urandom, and where setmac.CHECK_PID is set each nonce
+    costs an os.getpid call to detect forks. Pooled nonces are also
+    taken without that check, as on Pythons with os.register_at_fork
+    (only safe here as nothing forks)."""
+    urandom, getpid = os.urandom, os.getpid
+    calls = {"urandom": 0, "getpid": 0}
+    def counting_urandom(k):
+        calls["urandom"] += 1
+        return urandom(k)
+    def counting_getpid():
+        calls["getpid"] += 1
+        return getpid()
+
+    pool, check_pid = setmac._nonce_pool, setmac.CHECK_PID
+    print "%-8s %12s %12s %12s %10s" % ("nonces", "urandom/op", "getpid/op", "us/nonce", "tree")
+    try:
+        for name, size, check in [("direct", setmac.MACLEN, check_pid), ("pooled", setmac.NONCE_POOL_SIZE, check_pid),
+                                  ("no check", setmac.NONCE_POOL_SIZE, False)]:
+            if name == "no check" and not check_pid:
+                continue
+            setmac._nonce_pool = setmac.NoncePool(size)
+            setmac.CHECK_PID = check
+            elapsed = timed(lambda: [setmac.nonce() for i in xrange(nonces)])
+
+            os.urandom, os.getpid = counting_urandom, counting_getpid
+            try:
+                calls["urandom"] = calls["getpid"] = 0
+                for i in xrange(nonces):
+                    setmac.nonce()
+                counted = dict(calls)
+            finally:
+                os.urandom, os.getpid = urandom, getpid
+
+            built = timed(lambda: make_tree(tree_size), 1)
+            print "%-8s %12.3f %12.3f %12.3f %9.2fs" % (name, float(counted["urandom"]) / nonces, float(counted["getpid"]) / nonces,
+                                                      1e6 * elapsed / nonces, built)
+    finally:
+        setmac._nonce_pool, setmac.CHECK_PID = pool, check_pid
+    print "(%d nonces, tree of %d rows)" % (nonces, tree_size)
+
+class CountingCursor(sqlite3.Cursor):
+    """Cursor counting the statements it executes."""
+    def execute(self, *args):
+        self.connection.statements += 1
+        verb = args[0].split(None, 1)[0].upper()
+        if verb == "RELEASE":
+            # the savepoints of VerifiableRoot.atomic are not nested,
+            # so releasing one commits
+            self.connection.commits += 1
+        result = super(CountingCursor, self).execute(*args)
+        if verb in ("INSERT", "UPDATE", "DELETE"):
+            self.connection.writes += 1
+            self.connection.rows_written += max(self.rowcount, 0)
+        return result
+
+    def executemany(self, *args):
+        self.connection.statements += 1
+        self.connection.writes += 1
+        result = super(CountingCursor, self).executemany(*args)
+        self.connection.rows_written += max(self.rowcount, 0)
+        return result
+
+class CountingConnection(sqlite3.Connection):
+    """Connection counting the statements executed by its cursors,
+    i.e. the database round trips of a tree, how many of them write
+    and the rows they change, and its commits."""
+    statements = 0
+    writes = 0
+    rows_written = 0
+    commits = 0
+
+    def cursor(self, factory=CountingCursor):
+        return super(CountingConnection, self).cursor(factory)
+
+    def commit(self):
+        self.commits += 1
+        return super(CountingConnection, self).commit()
+
+def bench_btree(n=20000, queries=50, fanouts=(16, 64)):
+    """Compares the statements executed per range verification on a
+    freshly opened VerifiableTree and VerifiableBTree of n rows."""
+    rows = [Row(i, random.randint(1, n)) for i in xrange(1, n + 1)]
+    bounds = [sorted(random.randint(1, n) for j in xrange(2)) for i in xrange(queries)]
+    layouts = [("avl", lambda conn: treerange.VerifiableTree("bench", "value", "INTEGER", None, conn, None))]
+    for fanout in fanouts:
+        layouts.append(("btree-%d" % fanout,
+                        lambda conn, fanout=fanout: treerange.VerifiableBTree("bench", "value", "INTEGER", None, conn, None, None, fanout)))
+
+    print "%-12s %12s %12s %12s" % ("layout", "build", "stmts/query", "verify")
+    for name, open_tree in layouts:
+        conn = sqlite3.connect(":memory:", factory=CountingConnection)
+        start = time.time()
+        open_tree(conn).build(rows)
+        t_build = time.time() - start
+
+        statements = 0
+        start = time.time()
+        for rmin, rmax in bounds:
+            # a cold cache, as for a new request
+            tree = open_tree(conn)
+            subset = [row for row in rows if rmin <= row.value <= rmax]
+            conn.statements = 0
+            assert(tree.verify(subset, rmin, rmax))
+            statements += conn.statements
+        t_verify = time.time() - start
+
+        print "%-12s %11.3fs %12.1f %11.3fs" % (name, t_build, float(statements) / queries, t_verify)
+    print "(%d rows, %d range verifications)" % (n, queries)
+
+def bench_fetch(n=10000, queries=30, depths=(1, 2, 4, 6)):
+    """Compares the statements executed and nodes loaded per range
+    verification on a freshly opened VerifiableTree of n rows, for
+    several fetch depths."""
+    rows = [Row(i, random.randint(1, n)) for i in xrange(1, n + 1)]
+    bounds = [sorted(random.randint(1, n) for j in xrange(2)) for i in xrange(queries)]
+    conn = sqlite3.connect(":memory:", factory=CountingConnection)
+    treerange.VerifiableTree("bench", "value", "INTEGER", None, conn, None).build(rows)
+
+    print "%-6s %12s %12s %10s" % ("depth", "stmts/query", "nodes/query", "verify")
+    for depth in depths:
+        statements = nodes = 0
+        start = time.time()
+        for rmin, rmax in bounds:
+            # a cold cache, as for a new request
+            tree = treerange.VerifiableTree("bench", "value", "INTEGER", None, conn, None, None, None, depth)
+            subset = [row for row in rows if rmin <= row.value <= rmax]
+            conn.statements = 0
+            assert(tree.verify(subset, rmin, rmax))
+            statements += conn.statements
+            nodes += len(tree.cache)
+        elapsed = time.time() - start
+        print "%-6d %12.1f %12.1f %9.3fs" % (depth, float(statements) / queries, float(nodes) / queries, elapsed)
+    print "(%d rows, %d range verifications)" % (n, queries)
+
+def bench_cache(n=5000, operations=300, budgets=(None, 5000, 1000, 200)):
+    """Runs a mix of range verifications and inserts on a tree of n
+    rows with several node cache budgets, reporting the cache hit
+    rate, the statements per operation and the nodes left cached."""
+    rows = [Row(i, random.randint(1, n)) for i in xrange(1, n + 1)]
+    bounds = [sorted(random.randint(1, n) for j in xrange(2)) for i in xrange(operations)]
+
+    print "%-8s %9s %12s %8s %9s" % ("budget", "hit rate", "stmts/op", "nodes", "time")
+    for budget in budgets:
+        conn = sqlite3.connect(":memory:", factory=CountingConnection)
+        treerange.VerifiableTree("bench", "value", "INTEGER", None, conn, None).build(rows)
+        tree = treerange.VerifiableTree("bench", "value", "INTEGER", None, conn, None, cache_nodes=budget)
+        inserted = list(rows)
+        conn.statements = 0
+        start = time.time()
+        for i, (rmin, rmax) in enumerate(bounds):
+            if i % 3 == 2:
+                row = Row(n + 1 + i, random.randint(1, n))
+                tree.insert(row)
+                inserted.append(row)
+            else:
+                assert(tree.verify([row for row in inserted if rmin <= row.value <= rmax], rmin, rmax))
+        elapsed = time.time() - start
+        stats = tree.cache.stats()
+        print "%-8s %8.1f%% %12.1f %8d %8.3fs" % (budget, 100.0 * stats["hits"] / (stats["hits"] + stats["misses"]),
+                                                  float(conn.statements) / operations, stats["nodes"], elapsed)
+    print "(%d rows, %d operations, 1/3 inserts)" % (n, operations)
+
+class WriteThroughTree(treerange.VerifiableTree):
+    """A VerifiableTree writing each node as it is rehashed."""
+    write_back = False
+
+def bench_write_back(tree_sizes=(500, 2000, 8000), inserts=200):
+    """Compares the commits and write statements per insert into trees
+    of several sizes, with nodes written back at the end of each
+    insert and written through by each update_hook."""
+    print "%-8s %-14s %14s %14s %9s" % ("rows", "writes", "commits/insert", "writes/insert", "time")
+    for tree_size in tree_sizes:
+        rows = [Row(i, random.randint(1, tree_size)) for i in xrange(1, tree_size + 1)]
+        new_rows = [Row(tree_size + i, random.randint(1, tree_size)) for i in xrange(1, inserts + 1)]
+        for name, tree_class in (("write-through", WriteThroughTree), ("write-back", treerange.VerifiableTree)):
+            conn = sqlite3.connect(":memory:", factory=CountingConnection)
+            tree = tree_class("bench", "value", "INTEGER", None, conn, None)
+            tree.build(rows)
+            conn.commits = conn.writes = 0
+            start = time.time()
+            for row in new_rows:
+                tree.insert(row)
+            elapsed = time.time() - start
+            print "%-8d %-14s %14.2f %14.2f %8.3fs" % (tree_size, name, float(conn.commits) / inserts,
+                                                      float(conn.writes) / inserts, elapsed)
+    print "(%d inserts per tree)" % inserts
+
+def bench_batch(tree_size=2000, batch_sizes=(1, 10, 100)):
+    """Counts update_hook calls per insert when inserting rows one by
+    one and in batches of several inserts."""
+    update_hook = treerange.VerifiableTreeNode.update_hook
+    calls = [0]
+    def counting_update_hook(node):
+        calls[0] += 1
+        update_hook(node)
+
+    rows = [Row(i, random.randint(1, tree_size)) for i in xrange(1, tree_size + 1)]
+    treerange.VerifiableTreeNode.update_hook = counting_update_hook
+    try:
+        for batch_size in batch_sizes:
+            tree = treerange.VerifiableTree("bench", "value", "INTEGER", None, sqlite3.connect(":memory:"), None)
+            calls[0] = 0
+            start = time.time()
+            for i in xrange(0, tree_size, batch_size):
+                with tree.batch():
+                    for row in rows[i:i + batch_size]:
+                        tree.insert(row)
+            elapsed = time.time() - start
+            print "batches of %-4d %6.2f update_hook calls per insert, %.3fs" % (batch_size, float(calls[0]) / tree_size, elapsed)
+    finally:
+        treerange.VerifiableTreeNode.update_hook = update_hook
+
+class FingerlessTree(treerange.VerifiableTree):
+    """A VerifiableTree walking down from the root on every insert."""
+    def finger_path(self, key):
+        return None
+
+def bench_finger(tree_size=2000):
+    """Compares the statements and node steps (left/right lookups) per
+    insert of increasing and decreasing keys, with and without the
+    fingers of the tree."""
+    node_class = treerange.VerifiableTreeNode
+    left, right = node_class.left, node_class.right
+    steps = [0]
+    def counting(prop):
+        def get(node):
+            steps[0] += 1
+            return prop.fget(node)
+        return property(get, prop.fset)
+
+    node_class.left, node_class.right = counting(left), counting(right)
+    try:
+        print "%-12s %-10s %12s %12s %10s" % ("order", "tree", "stmts/insert", "steps/insert", "time")
+        for order in ("increasing", "decreasing"):
+            ids = range(1, tree_size + 1)
+            if order == "decreasing":
+                ids.reverse()
+            rows = [Row(i, i) for i in ids]
+            for name, tree_class in (("fingers", treerange.VerifiableTree), ("root walk", FingerlessTree)):
+                conn = sqlite3.connect(":memory:", factory=CountingConnection)
+                tree = tree_class("bench", "value", "INTEGER", None, conn, None)
+                conn.statements = steps[0] = 0
+                start = time.time()
+                for row in rows:
+                    tree.insert(row)
+                elapsed = time.time() - start
+                print "%-12s %-10s %12.2f %12.2f %9.3fs" % (order, name, float(conn.statements) / tree_size,
+                                                           float(steps[0]) / tree_size, elapsed)
+    finally:
+        node_class.left, node_class.right = left, right
+    print "(%d inserts)" % tree_size
+
+def bench_policy(tree_size=2000):
+    """Compares the rotations, update_hook calls, INSERT, UPDATE and
+    DELETE statements and the rows they change per operation of the
+    balancing policies on a VerifiableTree, on random inserts,
+    increasing inserts, random deletes and the Zipf distributed
+    inserts and deletes of treebench. Nodes are written back with one
+    statement at the end of each operation, so the policies differ in
+    rows rather than statements."""
+    node_class = balancedtree.BalancedTreeNode
+    rotate_left, rotate_right = node_class.rotate_left, node_class.rotate_right
+    update_hook = treerange.VerifiableTreeNode.update_hook
+    rotations, hooks = [0], [0]
+    def counting(fn, counter):
+        def counted(*args):
+            counter[0] += 1
+            return fn(*args)
+        return counted
+
+    node_class.rotate_left = counting(rotate_left, rotations)
+    node_class.rotate_right = counting(rotate_right, rotations)
+    treerange.VerifiableTreeNode.update_hook = counting(update_hook, hooks)
+    policies = [("avl", balancedtree.AVLPolicy), ("weight", balancedtree.WeightBalancedPolicy),
+                ("treap", balancedtree.TreapPolicy)]
+    try:
+        print "%-8s %-10s %10s %10s %10s %10s %8s %9s" % ("policy", "workload", "rotations", "hooks", "writes", "rows", "height", "time")
+        for name, policy in policies:
+            conn = sqlite3.connect(":memory:", factory=CountingConnection)
+            tree = treerange.VerifiableTree("bench", "value", "INTEGER", None, conn, None, None, policy())
+            random_rows = [Row(i, random.randint(1, tree_size)) for i in xrange(1, tree_size + 1)]
+            sorted_rows = [Row(i, i) for i in xrange(tree_size + 1, 2 * tree_size + 1)]
+            deleted_rows = random.sample(random_rows + sorted_rows, tree_size)
+
+            # the row of key k is Row(k + 1, k) in a tree of its own
+            zipf_tree = treerange.VerifiableTree("zipf", "value", "INTEGER", None, conn, None, None, policy())
+            prefill, toggles = treebench.zipf_workload(tree_size, random.Random(tree_size))
+            for k in prefill:
+                zipf_tree.insert(Row(k + 1, k))
+
+            workloads = [("random", tree, [(tree.insert, row) for row in random_rows]),
+                         ("increasing", tree, [(tree.insert, row) for row in sorted_rows]),
+                         ("delete", tree, [(tree.delete, row) for row in deleted_rows]),
+                         ("zipf", zipf_tree, [(getattr(zipf_tree, op), Row(k + 1, k)) for op, k in toggles])]
+            for workload, t, operations in workloads:
+                rotations[0] = hooks[0] = conn.writes = conn.rows_written = 0
+                start = time.time()
+                for operation, row in operations:
+                    operation(row)
+                elapsed = time.time() - start
+                ops = float(len(operations))
+                print "%-8s %-10s %10.2f %10.2f %10.2f %10.2f %8d %8.3fs" % (name, workload, rotations[0] / ops, hooks[0] / ops,
+                                                                          conn.writes / ops, conn.rows_written / ops,
+                                                                          t.root.height, elapsed)
+    finally:
+        node_class.rotate_left, node_class.rotate_right = rotate_left, rotate_right
+        treerange.VerifiableTreeNode.update_hook = update_hook
+    print "(per operation, %d operations each; writes are INSERT, UPDATE and DELETE statements, rows those they change)" % tree_size
+
+def node_bytes(node):
+    """Returns the size of a node object itself, with its __dict__ if
+    it has one."""
+    size = sys.getsizeof(node)
+    if hasattr(node, "__dict__"):
+        size += sys.getsizeof(node.__dict__)
+    return size
+
+class DictNode(object):
+    """A node without __slots__, holding its fields in __dict__."""
+
+def as_dict_node(node):
+    """Returns a DictNode with the fields of node, as stored by nodes
+    before they had __slots__."""
+    copy = DictNode()
+    for cls in type(node).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            # fields shadowed by properties were never stored
+            if not isinstance(getattr(type(node), name), property) and hasattr(node, name):
+                setattr(copy, name, getattr(node, name))
+    return copy
+
+def bench_node_memory(tree_size=20000):
+    """Compares the bytes per cached node of both tree layouts, with
+    __slots__ and with the same fields in a per-instance __dict__.
+    Only the node objects are counted, not the keys and MACs they
+    refer to."""
+    rows = [Row(i, random.randint(1, tree_size)) for i in xrange(1, tree_size + 1)]
+    layouts = [("avl", treerange.VerifiableTree), ("btree", treerange.VerifiableBTree)]
+
+    print "%-8s %8s %12s %12s" % ("layout", "nodes", "__dict__", "__slots__")
+    for name, tree_class in layouts:
+        conn = sqlite3.connect(":memory:")
+        tree_class("bench", "value", "INTEGER", None, conn, None).build(rows)
+        # load every node into the cache
+        tree = tree_class("bench", "value", "INTEGER", None, conn, None)
+        tree.verify(rows, None, None)
+        stack = [tree.root]
+        while stack:
+            node = stack.pop()
+            if name == "avl":
+                stack.extend(child for child in (node.left, node.right) if child)
+            elif not node.leaf:
+                stack.extend(node.get_child(i) for i in xrange(len(node.children)))
+
+        nodes = tree.cache.values()
+        slotted = sum(node_bytes(node) for node in nodes)
+        unslotted = sum(node_bytes(as_dict_node(node)) for node in nodes)
+        print "%-8s %8d %11.1fB %11.1fB" % (name, len(nodes), float(unslotted) / len(nodes), float(slotted) / len(nodes))
+    print "(bytes per cached node of a %d row tree)" % tree_size
+
+class HeapTree(treerange.VerifiableTree):
+    """A VerifiableTree kept in the format 3 table layout: no primary
+    key, and a separate index on row_id."""
+    tree_format = 3
+    indexed = True
+
+    def create_table(self, c, table_name):
+        c.execute("""CREATE TABLE IF NOT EXISTS %s
+                     (left INTEGER,
+                     right INTEGER,
+                     row_id INTEGER,
+                     row_key %s,
+                     mac BLOB,
+                     size INTEGER)""" % (table_name, self.type_name))
+        if self.indexed:
+            c.execute("CREATE INDEX IF NOT EXISTS %s__row_id ON %s (row_id)" % (table_name, table_name))
+
+    def migrate_keyed(self):
+        pass
+
+class UnindexedTree(HeapTree):
+    """A VerifiableTree in the format 3 layout as it was before the
+    row_id index: every lookup by row id scans the table."""
+    indexed = False
+
+def bench_schema(tree_sizes=(10 ** 4, 10 ** 5), operations=200, cache_nodes=1000, unindexed_sizes=10 ** 4, unindexed_operations=5):
+    """Compares the time per insert and delete and the database size of
+    a tree of each size in three table layouts, each opened from the
+    previous one: unindexed, the format 3 layout without any index, as
+    the tables were first created; format 3, which had gained an index
+    on row_id, created when it is opened; and format 4, keyed by row_id,
+    migrated to when it is opened. The unindexed layout scans the table
+    for each level of a fetch, so it is only run for sizes up to
+    unindexed_sizes and with unindexed_operations operations. Older
+    layouts (hex MACs, no sizes) differ in the MACs stored, not in the
+    lookups, and are not compared.
+
+    The trees are kept in a temporary file with synchronous off and a
+    small node cache, so the timings show the node lookups rather than
+    fsyncs. Building a tree holds all of its nodes in memory, so the
+    larger sizes need several GB:
+
+      python -c "import benchmark; benchmark.bench_schema((10 ** 5, 10 ** 6, 10 ** 7))"
+    """
+    print "%-9s %-10s %9s %11s %11s %9s" % ("rows", "layout", "open", "insert", "delete", "size")
+    for tree_size in tree_sizes:
+        rows = [Row(i, random.randint(1, tree_size)) for i in xrange(1, tree_size + 1)]
+        random.shuffle(rows)
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("PRAGMA synchronous = OFF")
+            # built indexed, as building writes the nodes by row id
+            HeapTree("bench", "value", "INTEGER", None, conn, None).build(rows)
+            next_id = tree_size + 1
+            layouts = [("format 3", HeapTree, operations), ("format 4", treerange.VerifiableTree, operations)]
+            if tree_size <= unindexed_sizes:
+                conn.execute("DROP INDEX __verifiable_tree__bench__value__row_id")
+                layouts.insert(0, ("unindexed", UnindexedTree, unindexed_operations))
+            for name, tree_class, count in layouts:
+                start = time.time()
+                tree = tree_class("bench", "value", "INTEGER", None, conn, None, cache_nodes=cache_nodes)
+                opened = time.time() - start
+
+                start = time.time()
+                for i in xrange(count):
+                    tree.insert(Row(next_id + i, random.randint(1, tree_size)))
+                inserted = time.time() - start
+                next_id += count
+
+                start = time.time()
+                for i in xrange(count):
+                    tree.delete(rows.pop())
+                deleted = time.time() - start
+
+                pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+                size = pages * conn.execute("PRAGMA page_size").fetchone()[0]
+                print "%-9d %-10s %8.2fs %9.2fms %9.2fms %7.1fMB" % (tree_size, name, opened, 1000 * inserted / count,
+                                                                   1000 * deleted / count, size / 1e6)
+        finally:
+            conn.close()
+            os.remove(path)
+    print "(%d inserts and deletes per layout, %d when unindexed, %d cached nodes)" % (operations, unindexed_operations, cache_nodes)
+
+BENCHMARKS = {
+    "hmac_cache": bench_hmac_cache,
+    "backends": bench_backends,
+    "batch": bench_batch,
+    "btree": bench_btree,
+    "cache": bench_cache,
+    "fetch": bench_fetch,
+    "finger": bench_finger,
+    "node_memory": bench_node_memory,
+    "write_back": bench_write_back,
+    "policy": bench_policy,
+    "schema": bench_schema,
+    "nonce_pool": bench_nonce_pool,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+#
+# Implementation of high-fanout B+-trees with associated tests
+#
+
+import bisect
+import contextlib
+
+DEFAULT_FANOUT = 64
+
+class BPlusTree(object):
+    """
+    Implementation of a B+-tree: all key/value pairs are kept sorted in
+    the leaves, internal nodes hold up to fanout children separated by
+    fanout - 1 keys. Child i of an internal node holds the keys k with
+    node.keys[i-1] <= k < node.keys[i]. Keys must be unique.
+
+    Nodes follow the hook contract of balancedtree.BalancedTree: after
+    any batch of updates to a node's entries or children
+    node.update_hook is called, children before parents, so augmented
+    structure can be correctly populated. Nodes merged away are passed
+    to node.remove_hook instead. Inside a batch() update_hook calls are
+    deferred to the end of the batch.
+
+    Children are referred to by handles, which the tree only moves
+    around: node.handle() makes the handle of a node and
+    node.get_child(i) resolves node.children[i]. By default a handle is
+    the node itself.
+    """
+    def __init__(self, node_factory, fanout=DEFAULT_FANOUT):
+        """Initializes the tree to empty one. node_factory(leaf) makes
+        an empty leaf or internal node."""
+        assert(fanout >= 4)
+        self.root = None
+        self.node_factory = node_factory
+        self.fanout = fanout
+        # id(node) -> (level, node) of nodes awaiting update_hook while
+        # in a batch, None otherwise
+        self.dirty = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Defers update_hook calls to the end of the with block: the
+        operations inside only mark the nodes they touch dirty, and
+        when the outermost batch ends update_hook is called once per
+        dirty node, children before parents. Augmented data is stale
+        inside the block, and stays stale if the block raises: the
+        tree may be half split or merged then, so no hook is called."""
+        if self.dirty is not None:
+            yield self
+            return
+
+        self.dirty = {}
+        try:
+            yield self
+        except:
+            self.dirty = None
+            raise
+        dirty, self.dirty = self.dirty, None
+        self.run_hooks(dirty.values())
+
+    def min_entries(self, node):
+        """Returns the least number of entries (keys of a leaf,
+        children of an internal node) a non-root node may have."""
+        return self.fanout // 2
+
+    def descend(self, key):
+        """Walks down to the leaf that holds key, returning it and the
+        path of (node, child index) pairs above it."""
+        path = []
+        t = self.root
+        t.visit_hook()
+        while not t.leaf:
+            i = bisect.bisect_right(t.keys, key)
+            path.append((t, i))
+            t = t.get_child(i)
+            t.visit_hook()
+        return t, path
+
+    def insert(self, key, value):
+        """Inserts a key/value pair in the tree.
+
+        Splits overflowing nodes bottom-up; update_hook is called
+        exactly once on every node whose subtree changed, children
+        before parents."""
+        if not self.root:
+            self.root = self.node_factory(True)
+
+        leaf, path = self.descend(key)
+        i = bisect.bisect_right(leaf.keys, key)
+        leaf.keys.insert(i, key)
+        leaf.values.insert(i, value)
+
+        # (level, node) pairs, level being the height above the
+        # leaves, which never changes for a node
+        touched = [(0, leaf)]
+        node = leaf
+        split = self.split(node)
+        for level, (parent, i) in enumerate(reversed(path)):
+            if split:
+                separator, sibling = split
+                touched.append((level, sibling))
+                parent.keys.insert(i, separator)
+                parent.children.insert(i + 1, sibling.handle())
+            touched.append((level + 1, parent))
+            node = parent
+            split = self.split(node)
+
+        if split:
+            separator, sibling = split
+            touched.append((len(path), sibling))
+            root = self.node_factory(False)
+            root.keys = [separator]
+            root.children = [node.handle(), sibling.handle()]
+            touched.append((len(path) + 1, root))
+            self.root = root
+
+        self.run_hooks(touched)
+
+    def split(self, node):
+        """Splits node in two halves if it is overfull, returning the
+        (separator, new right sibling) pair, otherwise None."""
+        if len(node.children if not node.leaf else node.keys) <= self.fanout:
+            return None
+
+        sibling = self.node_factory(node.leaf)
+        if node.leaf:
+            mid = len(node.keys) // 2
+            sibling.keys, node.keys = node.keys[mid:], node.keys[:mid]
+            sibling.values, node.values = node.values[mid:], node.values[:mid]
+            return sibling.keys[0], sibling
+        else:
+            mid = len(node.children) // 2
+            separator = node.keys[mid - 1]
+            sibling.keys, node.keys = node.keys[mid:], node.keys[:mid - 1]
+            sibling.children, node.children = node.children[mid:], node.children[:mid]
+            return separator, sibling
+
+    def delete(self, key):
+        """Deletes the specified key from tree and returns its value.
+
+        Underfull nodes borrow from or are merged with a sibling
+        bottom-up. Same as insert, update_hook is called once per
+        touched node, children before parents; merged away nodes get
+        remove_hook instead."""
+        assert(self.root)
+
+        leaf, path = self.descend(key)
+        i = bisect.bisect_left(leaf.keys, key)
+        assert(i < len(leaf.keys) and leaf.keys[i] == key)
+        del leaf.keys[i]
+        value = leaf.values.pop(i)
+
+        touched = [(0, leaf)]
+        removed = []
+        node = leaf
+        for level, (parent, i) in enumerate(reversed(path)):
+            if len(node.keys if node.leaf else node.children) < self.min_entries(node):
+                self.fix_underflow(parent, i, node, level, touched, removed)
+            touched.append((level + 1, parent))
+            node = parent
+
+        if not self.root.leaf and len(self.root.children) == 1:
+            removed.append(self.root)
+            self.root = self.root.get_child(0)
+        elif self.root.leaf and not self.root.keys:
+            removed.append(self.root)
+            self.root = None
+
+        self.run_hooks([(level, t) for level, t in touched if t not in removed])
+        for t in removed:
+            if self.dirty is not None:
+                self.dirty.pop(id(t), None)
+            t.remove_hook()
+        return value
+
+    def fix_underflow(self, parent, i, node, level, touched, removed):
+        """Refills node, child i of parent at the given level, from a
+        sibling: either borrows one entry or merges the two nodes."""
+        if i > 0:
+            left = parent.get_child(i - 1)
+            left.visit_hook()
+            if len(left.keys if left.leaf else left.children) > self.min_entries(left):
+                if node.leaf:
+                    node.keys.insert(0, left.keys.pop())
+                    node.values.insert(0, left.values.pop())
+                    parent.keys[i - 1] = node.keys[0]
+                else:
+                    node.keys.insert(0, parent.keys[i - 1])
+                    node.children.insert(0, left.children.pop())
+                    parent.keys[i - 1] = left.keys.pop()
+                touched.append((level, left))
+                return
+        if i + 1 < len(parent.children):
+            right = parent.get_child(i + 1)
+            right.visit_hook()
+            if len(right.keys if right.leaf else right.children) > self.min_entries(right):
+                if node.leaf:
+                    node.keys.append(right.keys.pop(0))
+                    node.values.append(right.values.pop(0))
+                    parent.keys[i] = right.keys[0]
+                else:
+                    node.keys.append(parent.keys[i])
+                    node.children.append(right.children.pop(0))
+                    parent.keys[i] = right.keys.pop(0)
+                touched.append((level, right))
+                return
+            self.merge(parent, i, node, right)
+            removed.append(right)
+        else:
+            self.merge(parent, i - 1, left, node)
+            removed.append(node)
+            touched.append((level, left))
+
+    def merge(self, parent, i, left, right):
+        """Moves all entries of right, child i + 1 of parent, to left,
+        child i of parent, and unlinks right."""
+        if left.leaf:
+            left.keys.extend(right.keys)
+            left.values.extend(right.values)
+        else:
+            left.keys.append(parent.keys[i])
+            left.keys.extend(right.keys)
+            left.children.extend(right.children)
+        del parent.keys[i]
+        del parent.children[i + 1]
+
+    def run_hooks(self, touched):
+        """Calls update_hook once on each node of touched, a list of
+        (level, node) pairs, lower levels first; in a batch the nodes
+        are marked dirty instead."""
+        if self.dirty is not None:
+            for level, t in touched:
+                self.dirty[id(t)] = (level, t)
+            return
+
+        seen = set()
+        for level, t in sorted(touched, key=lambda pair: pair[0]):
+            if id(t) not in seen:
+                seen.add(id(t))
+                t.update_hook()
+
+    def build_from_sorted(self, items, node_factory=None):
+        """Fills an empty tree with the key/value pairs of items, which
+        must be sorted by key, in O(n) time. Leaves are filled to
+        fanout entries, except that the last two nodes of each level
+        share their entries evenly; update_hook is called once per
+        node, children before parents."""
+        assert(not self.root)
+        node_factory = node_factory or self.node_factory
+        items = list(items)
+        for a, b in zip(items, items[1:]):
+            assert(a[0] < b[0])
+        if not items:
+            return
+
+        def chunks(n):
+            """Returns the (lo, hi) bounds of n entries cut into nodes."""
+            count = -(-n // self.fanout)
+            bounds = [(i * self.fanout, min(n, (i + 1) * self.fanout)) for i in xrange(count)]
+            if count > 1 and bounds[-1][1] - bounds[-1][0] < self.fanout // 2:
+                lo = bounds[-2][0]
+                mid = (lo + n + 1) // 2
+                bounds[-2:] = [(lo, mid), (mid, n)]
+            return bounds
+
+        # level holds (least key, node) pairs
+        level = []
+        for lo, hi in chunks(len(items)):
+            node = node_factory(True)
+            node.keys = [key for key, value in items[lo:hi]]
+            node.values = [value for key, value in items[lo:hi]]
+            node.update_hook()
+            level.append((node.keys[0], node))
+
+        while len(level) > 1:
+            parents = []
+            for lo, hi in chunks(len(level)):
+                node = node_factory(False)
+                node.keys = [key for key, child in level[lo + 1:hi]]
+                node.children = [child.handle() for key, child in level[lo:hi]]
+                node.update_hook()
+                parents.append((level[lo][0], node))
+            level = parents
+
+        self.root = level[0][1]
+
+    def find(self, key):
+        """Returns the value stored under key or None if the key is
+        not present."""
+        if not self.root:
+            return None
+        leaf, path = self.descend(key)
+        i = bisect.bisect_left(leaf.keys, key)
+        if i < len(leaf.keys) and leaf.keys[i] == key:
+            return leaf.values[i]
+        return None
+
+    def height(self):
+        """Returns the number of levels of the tree."""
+        h = 0
+        t = self.root
+        while t:
+            h += 1
+            t = t.get_child(0) if not t.leaf else None
+        return h
+
+class BPlusTreeNode(object):
+    # see balancedtree.BalancedTreeNode
+    __slots__ = ("leaf", "keys", "values", "children")
+
+    def __init__(self, leaf):
+        """Initializes an empty node. Doesn't call update_hook."""
+        self.leaf = leaf
+        self.keys = []
+        # leaves only
+        self.values = []
+        # internal nodes only
+        self.children = []
+
+    def handle(self):
+        """Returns the handle parents store for this node."""
+        return self
+
+    def get_child(self, i):
+        """Returns the i-th child of an internal node."""
+        return self.children[i]
+
+    def visit_hook(self):
+        """A hook function called on every node find/insert/delete
+        walks through, just after entering it."""
+        pass
+
+    def update_hook(self):
+        """A hook function called after any batch of updates to
+        self.{keys,values,children} on node or any of its descendants.
+        It is guarranteed that update_hook of a node will be called
+        after all update_hook calls of its descendants.
+
+        Not called on nodes that are removed from the tree."""
+        pass
+
+    def remove_hook(self):
+        """A hook function called on nodes that delete dropped from
+        the tree, after all update_hook calls."""
+        pass
+
+def xor_test():
+    """Performs a simple XOR-based test."""
+    import random
+
+    hooked = []
+
+    class XORTestNode(BPlusTreeNode):
+        """Test for child hooks: maintains XOR of all values and the
+        number of keys in this subtree."""
+        def __init__(self, leaf):
+            super(XORTestNode, self).__init__(leaf)
+            self.xor = 0
+            self.size = 0
+
+        def update_hook(self):
+            """Updates node, by recalculating size and XOR."""
+            hooked.append(self)
+            self.xor = 0
+            self.size = 0
+            if self.leaf:
+                for v in self.values:
+                    self.xor ^= v
+                self.size = len(self.values)
+            else:
+                for child in self.children:
+                    self.xor ^= child.xor
+                    self.size += child.size
+
+    def check(t, node, lo=None, hi=None, depth=0):
+        """Checks key order, fill and uniform depth; returns depth."""
+        keys = node.keys
+        assert(keys == sorted(keys))
+        assert(lo is None or not keys or lo <= keys[0])
+        assert(hi is None or not keys or keys[-1] < hi)
+        if node is not t.root:
+            assert(len(keys if node.leaf else node.children) >= t.min_entries(node))
+        if node.leaf:
+            assert(len(keys) <= t.fanout)
+            return depth
+        assert(len(node.children) == len(keys) + 1 <= t.fanout)
+        bounds = [lo] + keys + [hi]
+        depths = set(check(t, child, bounds[i], bounds[i + 1], depth + 1)
+                     for i, child in enumerate(node.children))
+        assert(len(depths) == 1)
+        return depths.pop()
+
+    for fanout in [4, 5, 64]:
+        N = 1<<12
+        t = BPlusTree(XORTestNode, fanout)
+        arr = random.sample(xrange(N * 4), N)
+        values = {}
+        allxor = 0
+
+        for k in arr:
+            values[k] = random.randint(0, 1<<31)
+            t.insert(k, values[k])
+            allxor ^= values[k]
+            assert(len(set(hooked)) == len(hooked))
+            del hooked[:]
+
+        check(t, t.root)
+        assert(t.root.size == N and t.root.xor == allxor)
+        print "Built a tree with fanout=%d, height=%d, size=%d" % (fanout, t.height(), t.root.size)
+
+        for k in random.sample(arr, N // 2):
+            assert(t.find(k) == values[k])
+            assert(t.delete(k) == values[k])
+            assert(len(set(hooked)) == len(hooked))
+            del hooked[:]
+            allxor ^= values.pop(k)
+            N -= 1
+            assert(t.root.size == N and t.root.xor == allxor)
+            assert(t.find(k) is None)
+        check(t, t.root)
+
+        for k in sorted(values):
+            assert(t.delete(k) == values[k])
+            del hooked[:]
+            if t.root:
+                check(t, t.root)
+        assert(t.root is None)
+
+        for n in [0, 1, 2, fanout, fanout + 1, fanout * fanout + 1, 1000]:
+            items = [(k, random.randint(0, 1<<31)) for k in xrange(n)]
+            t = BPlusTree(XORTestNode, fanout)
+            t.build_from_sorted(items)
+            assert(len(set(hooked)) == len(hooked))
+            del hooked[:]
+            if n:
+                check(t, t.root)
+                assert(t.root.size == n)
+                assert(t.root.xor == reduce(lambda a, b: a ^ b, [v for k, v in items]))
+            for k, v in items:
+                assert(t.find(k) == v)
+            t.insert(n, 1)
+            t.delete(n)
+            del hooked[:]
+
+        # in a batch each dirty node is hooked once, at the end
+        t = BPlusTree(XORTestNode, fanout)
+        t.build_from_sorted((k, k) for k in xrange(0, 2000, 2))
+        del hooked[:]
+        with t.batch():
+            for k in xrange(1, 2000, 2):
+                t.insert(k, k)
+            for k in xrange(0, 2000, 4):
+                t.delete(k)
+            with t.batch():
+                t.insert(2000, 2000)
+            assert(not hooked)
+        assert(len(set(hooked)) == len(hooked))
+        check(t, t.root)
+        keys = [k for k in xrange(2000) if k % 4] + [2000]
+        assert(t.root.size == len(keys))
+        assert(t.root.xor == reduce(lambda a, b: a ^ b, keys))
+        del hooked[:]
+
+    print "All tests passed"
+
+if __name__ == '__main__':
+    xor_test()
@@ -5,45 +5,315 @@
 # Author: Madars Virza <madars@mit.edu> (c) 2012
 #
 
+import datetime
+import decimal
 import hashlib
 import hmac
+import itertools
+import multiprocessing
 import os
+import struct
+import threading
+import weakref
+
+try:
+    from hashlib import blake2b, blake2s
+except ImportError:
+    try:
+        from pyblake2 import blake2b, blake2s
+    except ImportError:
+        blake2b = blake2s = None
 
 HASH_FN = hashlib.sha256
 MACLEN = 256//8
 
-def H(key, s):
-    """Returns digest of HMAC(key, s). Wrapped for improved
-    readability."""
-    return hmac.new(str(key), str(s), HASH_FN).digest()
+# compress hashes dictionaries of at least COMPRESS_THRESHOLD pairs in a
+# pool of COMPRESS_WORKERS processes (when COMPRESS_WORKERS > 1); each
+# worker gets chunks of COMPRESS_CHUNK pairs.
+COMPRESS_WORKERS = 1
+COMPRESS_THRESHOLD = 10000
+COMPRESS_CHUNK = 2500
+
+def _new_hmac(key):
+    return hmac.new(key, None, HASH_FN)
+
+def _blake2_factory(fn, max_key_size):
+    def new(key):
+        # as in HMAC, keys longer than allowed are hashed first
+        if len(key) > max_key_size:
+            key = fn(key, digest_size=MACLEN).digest()
+        return fn(key=key, digest_size=MACLEN)
+    return new
+
+# Digest backends used by H, by name. Each maps a key to a keyed hash
+# object with the hashlib interface producing MACLEN-byte digests.
+# BLAKE2 is keyed natively, so one hash call replaces the two of HMAC;
+# it needs Python 3.6+ or the pyblake2 package.
+BACKENDS = {"hmac-sha256": _new_hmac}
+if blake2b:
+    BACKENDS["blake2b"] = _blake2_factory(blake2b, 64)
+    BACKENDS["blake2s"] = _blake2_factory(blake2s, 32)
+DEFAULT_BACKEND = "hmac-sha256"
+
+# Hash objects that have already absorbed their key, indexed by
+# (backend, key). Copying one is cheaper than keying a fresh HMAC,
+# which hashes both key pads every time.
+_hmac_cache = {}
+HMAC_CACHE_SIZE = 1024
+
+def keyed_hmac(key, backend=DEFAULT_BACKEND):
+    """Returns a (cached) hash object of the given backend keyed with
+    key, that has not processed any message yet. Callers must copy()
+    it before use."""
+    key = str(key)
+    try:
+        return _hmac_cache[backend, key]
+    except KeyError:
+        if backend not in BACKENDS:
+            raise ValueError("Unknown or unavailable digest backend %r" % backend)
+        if len(_hmac_cache) >= HMAC_CACHE_SIZE:
+            _hmac_cache.clear()
+        h = _hmac_cache[backend, key] = BACKENDS[backend](key)
+        return h
+
+def H(key, s, backend=DEFAULT_BACKEND):
+    """Returns digest of HMAC(key, s), or of the keyed hash of the
+    given backend. Wrapped for improved readability."""
+    h = keyed_hmac(key, backend).copy()
+    h.update(str(s))
+    return h.digest()
+
+def encode_value(v):
+    """Returns a canonical, typed, length-prefixed binary encoding of
+    v: a type tag, the length of the payload as 4 bytes big-endian and
+    the payload itself.
+
+    Values are encoded by how SQLite stores them, so that a value and
+    its round trip through a tree table encode the same: booleans and
+    numbers with an integral value are tagged "I" (decimal digits),
+    other numbers "D" (normalized decimal), and str, unicode (as
+    UTF-8) and dates/times (in ISO format, as stored by sqlite3) are
+    tagged "T". None is "N" and buffers are "B"; anything else falls
+    back to its repr, tagged "R"."""
+    if v is None:
+        tag, payload = "N", ""
+    elif isinstance(v, (bool, int, long)):
+        tag, payload = "I", str(int(v))
+    elif isinstance(v, (float, decimal.Decimal)):
+        if isinstance(v, float):
+            v = decimal.Decimal(repr(v))
+        if v.is_finite() and v == v.to_integral_value():
+            tag, payload = "I", str(int(v))
+        else:
+            tag, payload = "D", str(v.normalize())
+    elif isinstance(v, str):
+        tag, payload = "T", v
+    elif isinstance(v, unicode):
+        tag, payload = "T", v.encode("utf-8")
+    elif isinstance(v, datetime.datetime):
+        tag, payload = "T", v.isoformat(" ")
+    elif isinstance(v, (datetime.date, datetime.time)):
+        tag, payload = "T", v.isoformat()
+    elif isinstance(v, buffer):
+        tag, payload = "B", str(v)
+    else:
+        tag, payload = "R", repr(v)
+    return tag + struct.pack(">I", len(payload)) + payload
 
-def kvhash(key, k, v):
-    """Returns value for repr(key)/repr(value) pair that should be
-    computationally hard to forge. For real-world usage one must check
-    that repr is collision-free for key/value pairs used."""
-    return H(key, '%s|%s' % (H(key, repr(k)), H(key, repr(v))))
+# kvhash versions:
+#   1 - H(H(repr(k))|H(repr(v))), three HMACs per pair
+#   2 - H(encode_value(k) + encode_value(v)), a single HMAC per pair
+KVHASH_VERSION = 2
+
+def kvhash(key, k, v, backend=DEFAULT_BACKEND, version=KVHASH_VERSION):
+    """Returns value for key/value pair that should be computationally
+    hard to forge. Version 1 hashes repr(key)/repr(value); for
+    real-world usage one must check that repr is collision-free for
+    key/value pairs used. Version 2 hashes the encode_value encodings,
+    which are unambiguous."""
+    if version == 1:
+        return H(key, '%s|%s' % (H(key, repr(k), backend), H(key, repr(v), backend)), backend)
+    return H(key, encode_value(k) + encode_value(v), backend)
+
+def hash_to_int(h):
+    """Returns MACLEN-byte hash h as a (wide) integer."""
+    return int(h.encode("hex"), 16)
+
+def int_to_hash(n):
+    """Inverse of hash_to_int: returns integer n as a MACLEN-byte
+    hash."""
+    return ("%0*x" % (2*MACLEN, n)).decode("hex")
 
 def xor_hashes(a, b):
     """Returns XOR of two hashes"""
     assert(len(a) == len(b))
     
-    return "".join(chr(ord(x) ^ ord(y)) for (x, y) in zip(a, b))
+    return int_to_hash(hash_to_int(a) ^ hash_to_int(b))
+
+class XORAccumulator(object):
+    """Accumulates XOR of many MACLEN-byte hashes.
+
+    Hashes are folded into a single wide integer, so each added hash
+    costs one conversion and one integer XOR instead of MACLEN
+    Python-level character operations. Use digest() to get the
+    accumulated value back as a hash."""
+    def __init__(self, h=None):
+        """Initializes accumulator to empty_compressed_MAC, or to h
+        if given."""
+        self.acc = 0
+        if h is not None:
+            self.add(h)
+
+    def add(self, h):
+        """XORs a single hash into the accumulator."""
+        assert(len(h) == MACLEN)
+        self.acc ^= int(h.encode("hex"), 16)
+
+    def update(self, hashes):
+        """XORs every hash of an iterable into the accumulator."""
+        acc = self.acc
+        for h in hashes:
+            assert(len(h) == MACLEN)
+            acc ^= int(h.encode("hex"), 16)
+        self.acc = acc
+
+    def merge(self, other):
+        """XORs the contents of another accumulator into this one."""
+        self.acc ^= other.acc
+
+    def digest(self):
+        """Returns the accumulated XOR as a hash."""
+        return int_to_hash(self.acc)
 
 def rand(k=32):
     """Returns k random bytes suitable for cryptographical purposes."""
     return os.urandom(k)
 
+NONCE_POOL_SIZE = 4096
+
+# whether nonce pools look for a fork by the process id, as no fork
+# hook discards their buffers (before Python 3.7)
+CHECK_PID = not hasattr(os, "register_at_fork")
+
+class NoncePool(object):
+    """Hands out nonces sliced from a buffer of os.urandom output, so
+    that one urandom call serves NONCE_POOL_SIZE//MACLEN nonces.
+
+    Nonces are as unpredictable as direct os.urandom calls, as long as
+    the buffer itself stays secret; since every nonce ends up in a
+    public MAC anyway, it only matters that no slice is handed out
+    twice. Slices are taken under a lock, and a forked child, which
+    would otherwise hand out the same nonces as its parent, discards
+    the buffer: all pools are reset by a single os.register_at_fork
+    hook where available, otherwise (see CHECK_PID) a pool keeps the
+    process id of its buffer and refills it when the id changed, at
+    the cost of a getpid call per nonce."""
+    def __init__(self, size=NONCE_POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.reset()
+        _nonce_pools.add(self)
+
+    def reset(self):
+        """Discards the buffered randomness."""
+        self.buf, self.pos, self.pid = "", 0, None
+
+    def get(self, k=MACLEN):
+        """Returns k fresh random bytes."""
+        with self.lock:
+            pid = os.getpid() if CHECK_PID else None
+            if self.pos + k > len(self.buf) or pid != self.pid:
+                self.buf, self.pos, self.pid = os.urandom(max(self.size, k)), 0, pid
+            r = self.buf[self.pos:self.pos + k]
+            self.pos += k
+        return r
+
+# every live NoncePool, for the fork hook
+_nonce_pools = weakref.WeakSet()
+
+def _reset_nonce_pools():
+    """Discards the buffers of all nonce pools, in a forked child."""
+    for pool in list(_nonce_pools):
+        pool.reset()
+
+if not CHECK_PID:
+    os.register_at_fork(after_in_child=_reset_nonce_pools)
+
+_nonce_pool = NoncePool()
+
+def nonce():
+    """Returns a fresh MACLEN-byte nonce for encrypting a compressed
+    MAC."""
+    return _nonce_pool.get(MACLEN)
+
 empty_compressed_MAC = chr(0) * MACLEN
 
-def compress(key2, d):
+def iterpairs(d):
+    """Returns an iterator over (key, value) pairs of d, which is
+    either a dictionary or an iterable of pairs."""
+    return d.iteritems() if hasattr(d, "iteritems") else iter(d)
+
+def compress(key2, d, workers=None, threshold=None, backend=DEFAULT_BACKEND, version=KVHASH_VERSION):
     """``Compresses'' dictionary into a single hash value, that, when
     encrypted with a CCA2 secure scheme will yield unforgeable MACing
-    scheme for dictionaries (see proof in our paper)."""
-    r = empty_compressed_MAC
-    for k, v in d.iteritems():
-        r = xor_hashes(r, kvhash(key2, k, v))
-    
-    return r
+    scheme for dictionaries (see proof in our paper).
+
+    d is either a dictionary or an iterable of (key, value) pairs with
+    distinct keys; an iterable is consumed incrementally. workers and
+    threshold override COMPRESS_WORKERS and COMPRESS_THRESHOLD for
+    this call."""
+    workers = COMPRESS_WORKERS if workers is None else workers
+    threshold = COMPRESS_THRESHOLD if threshold is None else threshold
+    pairs = iterpairs(d)
+
+    if workers > 1:
+        # buffer up to threshold pairs to decide whether going parallel
+        # pays off, without needing len(d)
+        head = list(itertools.islice(pairs, threshold))
+        if len(head) >= threshold:
+            return parallel_compress(key2, itertools.chain(head, pairs), workers, backend=backend, version=version)
+        pairs = iter(head)
+
+    acc = XORAccumulator()
+    acc.update(kvhash(key2, k, v, backend, version) for k, v in pairs)
+    return acc.digest()
+
+_pools = {}
+
+def _get_pool(workers):
+    """Returns a process pool of the given size, creating it on first
+    use and reusing it afterwards."""
+    if workers not in _pools:
+        _pools[workers] = multiprocessing.Pool(workers)
+    return _pools[workers]
+
+def _compress_chunk(args):
+    """Pool worker: returns XOR of kvhashes of a chunk of pairs as an
+    integer (see XORAccumulator)."""
+    key2, pairs, backend, version = args
+    acc = XORAccumulator()
+    acc.update(kvhash(key2, k, v, backend, version) for k, v in pairs)
+    return acc.acc
+
+def parallel_compress(key2, pairs, workers, chunk=None, backend=DEFAULT_BACKEND, version=KVHASH_VERSION):
+    """Same as compress, but hashes an iterable of (key, value) pairs
+    in a pool of worker processes. Chunks are hashed independently and
+    their partial results XOR-reduced, which gives the same value as
+    serial compress."""
+    chunk = COMPRESS_CHUNK if chunk is None else chunk
+    pairs = iter(pairs)
+
+    def chunks():
+        while True:
+            c = list(itertools.islice(pairs, chunk))
+            if not c:
+                return
+            yield (key2, c, backend, version)
+
+    acc = XORAccumulator()
+    for partial in _get_pool(workers).imap_unordered(_compress_chunk, chunks()):
+        acc.acc ^= partial
+    return acc.digest()
 
 def good_format(mac):
     assert(len(mac) == 2)
@@ -51,12 +321,12 @@ def good_format(mac):
     assert(len(mac[1].decode("hex")) == MACLEN)
     return True
 
-def extract_compressed_MAC(key1, mac):
+def extract_compressed_MAC(key1, mac, backend=DEFAULT_BACKEND):
     """Extracts compressed MAC from signature."""
     assert(good_format(mac))
     assert(good_format(mac))
     r, e = mac[0].decode("hex"), mac[1].decode("hex")
-    c = xor_hashes(H(key1, r), e)
+    c = xor_hashes(H(key1, r, backend), e)
     return c
 
 def marshall_MAC(mac):
@@ -67,28 +337,183 @@ def unmarshall_MAC(v):
     assert(good_format(mac))
     return mac
 
-def encrypt_compressed_MAC(key1, c):
+def encrypt_compressed_MAC(key1, c, backend=DEFAULT_BACKEND):
     """Encrypts compressed MAC with fresh randomness."""
-    r = rand()
-    return (r.encode("hex"), xor_hashes(H(key1, r), c).encode("hex"))    
+    r = nonce()
+    return (r.encode("hex"), xor_hashes(H(key1, r, backend), c).encode("hex"))    
+
+# Packed MACs are the binary form of (nonce, ciphertext) pairs: the
+# nonce and the ciphertext concatenated into PACKED_MACLEN raw bytes.
+PACKED_MACLEN = 2*MACLEN
 
-def sign(key1, key2, d):
+def pack_MAC(mac):
+    """Converts a hex (nonce, ciphertext) MAC into a packed MAC."""
+    assert(good_format(mac))
+    return mac[0].decode("hex") + mac[1].decode("hex")
+
+def unpack_MAC(packed):
+    """Converts a packed MAC into a hex (nonce, ciphertext) MAC."""
+    assert(len(packed) == PACKED_MACLEN)
+    return (packed[:MACLEN].encode("hex"), packed[MACLEN:].encode("hex"))
+
+def extract_packed_MAC(key1, packed, backend=DEFAULT_BACKEND):
+    """Extracts compressed MAC from a packed signature."""
+    assert(len(packed) == PACKED_MACLEN)
+    return xor_hashes(H(key1, packed[:MACLEN], backend), packed[MACLEN:])
+
+def encrypt_packed_MAC(key1, c, backend=DEFAULT_BACKEND):
+    """Encrypts compressed MAC with fresh randomness, returning a
+    packed MAC."""
+    r = nonce()
+    return r + xor_hashes(H(key1, r, backend), c)
+
+def sign(key1, key2, d, backend=DEFAULT_BACKEND, version=KVHASH_VERSION):
     """Creates a MAC for two sets."""
-    c = compress(key2, d)
-    return encrypt_compressed_MAC(key1, c)
+    c = compress(key2, d, backend=backend, version=version)
+    return encrypt_compressed_MAC(key1, c, backend)
 
-def verify(key1, key2, d, mac):
+def verify(key1, key2, d, mac, backend=DEFAULT_BACKEND, version=KVHASH_VERSION):
     """Returns True iff ``mac'' is a valid MAC for dictionary d."""
-    return extract_compressed_MAC(key1, c) == compress(key2, d)
+    return extract_compressed_MAC(key1, mac, backend) == compress(key2, d, backend=backend, version=version)
 
-def union(key1, mac1, mac2):
-    """Returns MAC of union of two sets."""
-    c1 = extract_compressed_MAC(key1, mac1)
-    c2 = extract_compressed_MAC(key2, mac1)
+def union(key1, mac1, mac2, backend=DEFAULT_BACKEND):
+    """Returns MAC of union of two disjoint sets."""
+    c1 = extract_compressed_MAC(key1, mac1, backend)
+    c2 = extract_compressed_MAC(key1, mac2, backend)
     c = xor_hashes(c1, c2)
     
-    return encrypt_compressed_MAC(key1, c)
-    
-# one could also implement remove for completeness, but it is not
-# required for our application.
+    return encrypt_compressed_MAC(key1, c, backend)
+
+def remove(key1, mac1, mac2, backend=DEFAULT_BACKEND):
+    """Returns MAC of set difference of two sets, where the second set
+    (MACed by mac2) is a subset of the first one (MACed by mac1)."""
+    # XOR is its own inverse, so removal is the same operation as
+    # union; only the precondition on the sets differs.
+    return union(key1, mac1, mac2, backend)
+
+def compress_delta(key2, added, removed, backend=DEFAULT_BACKEND, version=KVHASH_VERSION):
+    """Returns the compressed MAC that, XORed into the compressed MAC
+    of a dictionary, adds the pairs of added to it and removes the
+    pairs of removed from it. Both are dictionaries or iterables of
+    pairs, as in compress."""
+    acc = XORAccumulator()
+    acc.update(kvhash(key2, k, v, backend, version) for k, v in iterpairs(added))
+    acc.update(kvhash(key2, k, v, backend, version) for k, v in iterpairs(removed))
+    return acc.digest()
+
+def apply_delta(key1, key2, mac, added, removed, backend=DEFAULT_BACKEND, version=KVHASH_VERSION):
+    """Returns MAC of the dictionary MACed by mac, with the pairs of
+    dictionary added inserted and the pairs of dictionary removed
+    deleted. added must be disjoint from the MACed dictionary and
+    removed must be a subset of it. Costs one decryption and one
+    encryption, no matter how large the MACed dictionary is."""
+    c = xor_hashes(extract_compressed_MAC(key1, mac, backend), compress_delta(key2, added, removed, backend, version))
+    return encrypt_compressed_MAC(key1, c, backend)
+
+def apply_packed_delta(key1, key2, packed, added, removed, backend=DEFAULT_BACKEND, version=KVHASH_VERSION):
+    """Same as apply_delta, but for packed MACs."""
+    c = xor_hashes(extract_packed_MAC(key1, packed, backend), compress_delta(key2, added, removed, backend, version))
+    return encrypt_packed_MAC(key1, c, backend)
+
+def setmac_test():
+    """Checks setmac primitives against straightforward reference
+    implementations."""
+    key = rand().encode("hex")
+
+    for s in ["", "a", "x" * 1000]:
+        assert(H(key, s) == hmac.new(key, s, HASH_FN).digest())
+        assert(H(key, s) == H(key, s))
+        if blake2b:
+            assert(H(key, s, "blake2b") == blake2b(s, key=key, digest_size=MACLEN).digest())
+            assert(H(key, s, "blake2s") == blake2s(s, key=blake2s(key).digest()).digest())
+    hashes = [rand(MACLEN) for i in xrange(1000)]
+
+    expected = empty_compressed_MAC
+    for h in hashes:
+        expected = "".join(chr(ord(x) ^ ord(y)) for (x, y) in zip(expected, h))
+
+    acc = XORAccumulator()
+    acc.update(hashes)
+    assert(acc.digest() == expected)
+
+    acc = XORAccumulator(hashes[0])
+    rest = XORAccumulator()
+    rest.update(hashes[1:])
+    acc.merge(rest)
+    assert(acc.digest() == expected)
+    assert(XORAccumulator().digest() == empty_compressed_MAC)
+
+    d = dict((i, rand(8).encode("hex")) for i in xrange(1000))
+    expected = empty_compressed_MAC
+    for k, v in d.iteritems():
+        expected = "".join(chr(ord(x) ^ ord(y)) for (x, y) in zip(expected, kvhash(key, k, v)))
+    assert(compress(key, d) == expected)
+    assert(compress(key, d, workers=2, threshold=0) == expected)
+    assert(parallel_compress(key, d.iteritems(), 3, chunk=7) == expected)
+    assert(compress(key, {}, workers=2, threshold=0) == empty_compressed_MAC)
+    assert(compress(key, d.iteritems()) == expected)
+    assert(compress(key, d.items(), workers=2, threshold=10) == expected)
+    assert(compress(key, d.iteritems(), workers=2, threshold=5000) == expected)
+
+    c = compress(key, d)
+    mac = encrypt_compressed_MAC(key, c)
+    packed = pack_MAC(mac)
+    assert(len(packed) == PACKED_MACLEN)
+    assert(unpack_MAC(packed) == mac)
+    assert(extract_packed_MAC(key, packed) == c)
+    assert(extract_packed_MAC(key, encrypt_packed_MAC(key, c)) == c)
+
+    key2 = rand().encode("hex")
+    items = d.items()
+    d1, d2 = dict(items[:600]), dict(items[600:])
+    mac1, mac2 = sign(key, key2, d1), sign(key, key2, d2)
+    assert(verify(key, key2, d, union(key, mac1, mac2)))
+    assert(verify(key, key2, d1, remove(key, sign(key, key2, d), mac2)))
+    assert(not verify(key, key2, d1, mac2))
+
+    d3 = dict(items[500:700])
+    mac = apply_delta(key, key2, mac1, d2, dict(items[:500]))
+    assert(verify(key, key2, dict(items[500:]), mac))
+    packed = apply_packed_delta(key, key2, pack_MAC(mac), {}, d3)
+    assert(verify(key, key2, dict(items[700:]), unpack_MAC(packed)))
+
+    for k, v in [(1, 1), (True, 1), (1, 1.0), (2, decimal.Decimal("2.00")),
+                 (1.1, decimal.Decimal("1.10")), ("a", u"a"), (u"\xe9", u"\xe9".encode("utf-8")),
+                 (datetime.date(2012, 5, 1), u"2012-05-01"),
+                 (datetime.datetime(2012, 5, 1, 13, 7, 1), u"2012-05-01 13:07:01")]:
+        assert(encode_value(k) == encode_value(v))
+    for k, v in [(1, "1"), (None, ""), (1, 1.5), ("ab", "a"), (0.1, 0.10000001)]:
+        assert(encode_value(k) != encode_value(v))
+    assert(kvhash(key, "a", "bc") != kvhash(key, "ab", "c"))
+    assert(kvhash(key, 1, "x", version=1) == H(key, "%s|%s" % (H(key, "1"), H(key, "'x'"))))
+
+    for backend in BACKENDS:
+        mac = sign(key, key2, d, backend)
+        assert(verify(key, key2, d, mac, backend))
+        assert(backend == DEFAULT_BACKEND or not verify(key, key2, d, mac))
+        assert(compress(key, d.items(), workers=2, threshold=10, backend=backend) == compress(key, d, backend=backend))
+        assert(verify(key, key2, d, sign(key, key2, d, backend, 1), backend, 1))
+        assert(not verify(key, key2, d, sign(key, key2, d, backend, 1), backend))
+
+    pool = NoncePool(100)
+    nonces = [pool.get() for i in xrange(1000)]
+    assert(len(set(nonces)) == len(nonces))
+    assert(all(len(n) == MACLEN for n in nonces))
+    assert(len(pool.get(1000)) == 1000)
+    # a child of a bare fork takes fresh nonces, not the parent's next
+    # ones
+    pool.get()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(w, pool.get())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert(os.read(r, MACLEN) != pool.get())
+    os.close(r)
+    os.close(w)
+
+    print "All tests passed"
 
+if __name__ == '__main__':
+    setmac_test()
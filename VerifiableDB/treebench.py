@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Workload benchmarks for balancedtree. Run as
+#
+#   python treebench.py [options] [workload ...]
+#
+# to run the named workloads (all of them by default) and print one
+# JSON object per run, so results can be saved and compared between
+# runs. See python treebench.py --help for the options. The database
+# statements of each policy on a VerifiableTree are compared by
+# python benchmark.py policy.
+#
+
+import argparse
+import bisect
+import json
+import random
+import sys
+import time
+
+import balancedtree
+
+POLICIES = {
+    "avl": balancedtree.AVLPolicy,
+    "weight": balancedtree.WeightBalancedPolicy,
+    "treap": balancedtree.TreapPolicy,
+}
+
+class SizedNode(balancedtree.BalancedTreeNode):
+    """Node augmented with the size and key sum of its subtree, as a
+    stand-in for the cost of a typical update_hook."""
+    __slots__ = ("size", "total")
+
+    def __init__(self, key, value):
+        super(SizedNode, self).__init__(key, value)
+        self.size, self.total = 1, key
+
+    def update_hook(self):
+        self.size, self.total = 1, self.key
+        for child in (self.left, self.right):
+            if child:
+                self.size += child.size
+                self.total += child.total
+
+NODES = {
+    "plain": balancedtree.BalancedTreeNode,
+    "sized": SizedNode,
+}
+
+def zipf_sampler(n, s, rng):
+    """Returns a function drawing keys 0..n-1 with Zipf frequencies of
+    exponent s; the most frequent keys are spread over the key range."""
+    cdf, total = [], 0.0
+    for rank in xrange(1, n + 1):
+        total += rank ** -s
+        cdf.append(total)
+    keys = range(n)
+    rng.shuffle(keys)
+    return lambda: keys[min(bisect.bisect(cdf, rng.random() * total), n - 1)]
+
+def sorted_workload(n, rng):
+    """Inserts keys in increasing order."""
+    return [], [("insert", k) for k in xrange(n)]
+
+def random_workload(n, rng):
+    """Inserts keys in random order."""
+    keys = range(n)
+    rng.shuffle(keys)
+    return [], [("insert", k) for k in keys]
+
+def zipf_workload(n, rng):
+    """Toggles Zipf distributed keys in a tree of n/2 keys: a drawn key
+    is deleted if present and inserted otherwise, so updates
+    concentrate on a few hot spots."""
+    prefill = rng.sample(xrange(n), n // 2)
+    present = set(prefill)
+    draw = zipf_sampler(n, 1.1, rng)
+    ops = []
+    for i in xrange(n):
+        k = draw()
+        ops.append(("delete" if k in present else "insert", k))
+        present ^= set([k])
+    return prefill, ops
+
+def mixed_workload(n, rng):
+    """Alternates random inserts of new keys and deletes of random
+    present keys in a tree of n/2 keys, with some lookups."""
+    keys = range(2 * n)
+    rng.shuffle(keys)
+    prefill, fresh = keys[:n // 2], keys[n // 2:]
+    present = list(prefill)
+    ops = []
+    for i in xrange(n):
+        r = rng.random()
+        if r < 0.4:
+            k = fresh.pop()
+            present.append(k)
+            ops.append(("insert", k))
+        elif r < 0.8:
+            j = rng.randrange(len(present))
+            present[j], present[-1] = present[-1], present[j]
+            ops.append(("delete", present.pop()))
+        else:
+            ops.append(("find", rng.choice(present)))
+    return prefill, ops
+
+def range_workload(n, rng):
+    """Range scans of up to 1% of the keys over a tree of n keys, with
+    an insert of a new key every tenth operation."""
+    prefill = range(0, 2 * n, 2)
+    rng.shuffle(prefill)
+    ops = []
+    for i in xrange(n):
+        if i % 10 == 9:
+            ops.append(("insert", 2 * rng.randrange(n) + 1))
+        else:
+            lo = rng.randrange(2 * n)
+            ops.append(("range", (lo, lo + rng.randint(0, n // 50))))
+    return prefill, ops
+
+WORKLOADS = {
+    "sorted": sorted_workload,
+    "random": random_workload,
+    "zipf": zipf_workload,
+    "mixed": mixed_workload,
+    "range": range_workload,
+}
+
+def range_scan(tree, lo, hi):
+    """Returns the number of keys in [lo, hi], walking the nodes of the
+    range in order, like a range query."""
+    count, stack, t = 0, [], tree.root
+    while stack or t:
+        if t:
+            t.visit_hook()
+            if t.key < lo:
+                t = t.right
+            else:
+                stack.append(t)
+                t = t.left
+        else:
+            t = stack.pop()
+            if hi < t.key:
+                break
+            count += 1
+            t = t.right
+    return count
+
+class Counting(object):
+    """Counts the calls of a method of a class while in a with block,
+    including calls on subclasses that do not override it."""
+    def __init__(self, cls, name):
+        self.cls, self.name, self.calls = cls, name, 0
+
+    def __enter__(self):
+        self.original = self.cls.__dict__.get(self.name)
+        method = getattr(self.cls, self.name)
+        def counted(*args):
+            self.calls += 1
+            return method(*args)
+        setattr(self.cls, self.name, counted)
+        return self
+
+    def __exit__(self, *exc):
+        if self.original is not None:
+            setattr(self.cls, self.name, self.original)
+        else:
+            delattr(self.cls, self.name)
+
+def run(workload, node_class, policy=None, n=10000, seed=0):
+    """Runs workload (a WORKLOADS name) with n operations on a
+    BalancedTree of node_class nodes (a BalancedTreeNode subclass
+    taking the key and value) and the given policy, after filling it
+    with the workload's initial keys. Returns a dict of the timings
+    and counts of the operations (not of the filling)."""
+    rng = random.Random(seed)
+    prefill, ops = WORKLOADS[workload](n, rng)
+    tree = balancedtree.BalancedTree(node_class, policy)
+    for k in prefill:
+        tree.insert(k, k)
+
+    max_height = tree.root.height if tree.root else 0
+    with Counting(balancedtree.BalancedTreeNode, "rotate_left") as left, \
+         Counting(balancedtree.BalancedTreeNode, "rotate_right") as right, \
+         Counting(node_class, "update_hook") as hooks:
+        start = time.time()
+        for op, k in ops:
+            if op == "insert":
+                tree.insert(k, k)
+            elif op == "delete":
+                tree.delete(k)
+            elif op == "find":
+                tree.find(k)
+            else:
+                range_scan(tree, *k)
+            if tree.root and tree.root.height > max_height:
+                max_height = tree.root.height
+        elapsed = time.time() - start
+
+    return {
+        "workload": workload,
+        "ops": len(ops),
+        "seconds": round(elapsed, 6),
+        "ops_per_sec": round(len(ops) / elapsed, 1) if elapsed else None,
+        "rotations": left.calls + right.calls,
+        "hooks": hooks.calls,
+        "max_height": max_height,
+        "final_size": tree.root.weight if tree.root else 0,
+    }
+
+def load_node(name):
+    """Returns the node class of a NODES name or a dotted module.name
+    path."""
+    if name in NODES:
+        return NODES[name]
+    module, attr = name.rsplit(".", 1)
+    return getattr(__import__(module, fromlist=[attr]), attr)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Runs balancedtree workloads, printing a JSON object per run.")
+    parser.add_argument("workloads", nargs="*", metavar="workload",
+                        help="one of %s (default: all)" % ", ".join(sorted(WORKLOADS)))
+    parser.add_argument("-n", type=int, default=10000, help="operations per run (default: 10000)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--policy", action="append", choices=sorted(POLICIES),
+                        help="balancing policy, may be repeated (default: avl)")
+    parser.add_argument("--node", default="plain",
+                        help="node class: %s or a module.name path (default: plain)" % " or ".join(sorted(NODES)))
+    args = parser.parse_args(argv)
+    for workload in args.workloads:
+        if workload not in WORKLOADS:
+            parser.error("unknown workload %r" % workload)
+
+    node_class = load_node(args.node)
+    for workload in args.workloads or sorted(WORKLOADS):
+        for policy in args.policy or ["avl"]:
+            result = run(workload, node_class, POLICIES[policy](), args.n, args.seed)
+            result.update(policy=policy, node=args.node, n=args.n, seed=args.seed)
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
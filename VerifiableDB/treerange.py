@@ -4,44 +4,451 @@
 #
 
 import balancedtree
+import bplustree
+import collections
+import contextlib
+import datetime
+import decimal
+import json
 import setmac
+import sqlite3
+import sys
 from django.db import models
 
-class VerifiableTreeNode(balancedtree.BalancedTreeNode):
-    def __init__(self, row_id, tree):
-        c = tree.conn.cursor()
-        c.execute("SELECT left, right, row_key, mac FROM %s WHERE row_id = ?" % tree.table_name, (row_id,))
+# Version of the tree table layout:
+#   1 - node MACs stored as "nonce|ciphertext" hex strings in VARCHAR(100)
+#   2 - node MACs stored as setmac.PACKED_MACLEN byte BLOBs
+#   3 - subtree sizes stored in a size column and bound by the node MACs
+#   4 - row_id is the INTEGER PRIMARY KEY and row_key is indexed
+TREE_FORMAT = 4
+
+# Rows moved per transaction by VerifiableTree.migrate_keyed
+MIGRATE_CHUNK = 100000
+
+# Rows deleted per statement by VerifiableTree.delete_range, within the
+# default limit of 999 variables of a SQLite statement
+DELETE_CHUNK = 900
+
+# Levels of a subtree loaded by VerifiableTree.fetch in one statement
+FETCH_DEPTH = 4
+
+# Default node budget of a VerifiableTree node cache
+CACHE_NODES = 100000
+
+# Version of the B-tree table layout:
+#   1 - one row per node: JSON keys and child ids, concatenated packed
+#       child MACs
+BTREE_FORMAT = 1
+
+class VerifiableRoot(object):
+    """Bookkeeping shared by the verifiable tree layouts: the keys,
+    digest backend and kvhash version of a tree and its authenticated
+    root hash, kept in the verifiable_trees table of local_conn.
+
+    Subclasses provide root_id() and root_mac(), the values bound by
+    the root hash, load_root(), range_compressed_MAC() and
+    flush_writes()."""
+    tree_format = None
+    fanout = None
+    # set while in atomic(), whose savepoint commits the statements
+    in_transaction = False
+    # nodes are written back at the end of each batch, rather than by
+    # each update_hook
+    write_back = True
+    # nodes to write back by id while in a batch, None otherwise
+    writes = None
+
+    def open_metadata(self, backend):
+        """Loads the verifiable_trees row of the tree, creating it for
+        a new tree, and returns its (root_id, format) pair."""
+        c = self.local_conn.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS verifiable_trees
+                     (table_name VARCHAR(64) PRIMARY KEY,
+                     key1 CHAR(32),
+                     key2 CHAR(32),
+                     key3 CHAR(32),
+                     root_id INTEGER,
+                     counter INTEGER,
+                     root_hash VARCHAR(1024),
+                     format INTEGER,
+                     backend VARCHAR(32),
+                     kvhash_version INTEGER,
+                     fanout INTEGER)""")
+        c.execute("PRAGMA table_info(verifiable_trees)")
+        columns = [column[1] for column in c.fetchall()]
+        # columns missing from verifiable_trees created by older
+        # versions; their defaults describe the trees already in there
+        for column, definition in [("format", "INTEGER DEFAULT 1"),
+                                   ("backend", "VARCHAR(32) DEFAULT 'hmac-sha256'"),
+                                   ("kvhash_version", "INTEGER DEFAULT 1"),
+                                   ("fanout", "INTEGER")]:
+            if column not in columns:
+                c.execute("ALTER TABLE verifiable_trees ADD COLUMN %s %s" % (column, definition))
+        self.local_conn.commit()
+
+        c.execute("""SELECT key1, key2, key3, root_id, counter, root_hash, format, backend, kvhash_version, fanout
+                     FROM verifiable_trees WHERE table_name = ?""", (self.table_name,))
         data = c.fetchone()
+        if data:
+            self.key1, self.key2, self.key3, root_id, self.counter, self.root_hash, tree_format, backend, self.kvhash_version, fanout = data
+            self.backend = str(backend)
+            if fanout:
+                self.fanout = fanout
+        else:
+            self.key1 = setmac.rand(32).encode("hex")
+            self.key2 = setmac.rand(32).encode("hex")
+            self.key3 = setmac.rand(32).encode("hex")
+            self.backend = backend or setmac.DEFAULT_BACKEND
+            self.kvhash_version = setmac.KVHASH_VERSION
+            root_id = -1
+            tree_format = self.tree_format
+            self.counter = 1
+            self.root = None
+            self.recompute_root_hash()
+            c.execute("""INSERT INTO verifiable_trees
+                         (table_name,
+                         key1,
+                         key2,
+                         key3,
+                         root_id,
+                         counter,
+                         root_hash,
+                         format,
+                         backend,
+                         kvhash_version,
+                         fanout) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (self.table_name, self.key1, self.key2, self. key3, root_id, self.counter, self.root_hash, tree_format, self.backend, self.kvhash_version, self.fanout))
+            self.local_conn.commit()
+
         c.close()
+        return root_id, tree_format
+
+    def check_root(self):
+        computed_hash = setmac.kvhash(self.key3, self.counter, self.root_mac(), self.backend, self.kvhash_version).encode("hex")
+        assert(computed_hash == self.root_hash)
+
+    def recompute_root_hash(self):
+        self.root_hash = setmac.kvhash(self.key3, self.counter, self.root_mac(), self.backend, self.kvhash_version).encode("hex")
+
+    def bump_root(self):
+        self.counter += 1
+        self.recompute_root_hash()
+
+        c = self.local_conn.cursor()
+        c.execute("UPDATE verifiable_trees SET root_id = ?, counter = ?, root_hash = ? WHERE table_name = ?", (self.root_id(), self.counter, self.root_hash, self.table_name))
+        if not self.in_transaction:
+            self.local_conn.commit()
+        c.close()
+
+    @contextlib.contextmanager
+    def atomic(self):
+        """Runs the with block in a single transaction of local_conn,
+        opened with a savepoint. If the block raises, the savepoint is
+        rolled back, so neither the node rows nor verifiable_trees
+        change, the pending writes and cached nodes are dropped and
+        reload() restores the in-memory state; otherwise releasing the
+        savepoint commits the block. Nested blocks are part of the
+        outermost one."""
+        if self.in_transaction:
+            yield self
+            return
+
+        # savepoints are managed by hand, as sqlite3 would otherwise
+        # commit before the SAVEPOINT statement
+        isolation_level = self.local_conn.isolation_level
+        self.local_conn.isolation_level = None
+        c = self.local_conn.cursor()
+        c.execute("SAVEPOINT verifiable_tree")
+        self.in_transaction = True
+        try:
+            yield self
+        except:
+            exc_info = sys.exc_info()
+            self.in_transaction = False
+            self.writes = None
+            self.cache = {}
+            try:
+                try:
+                    c.execute("ROLLBACK TO verifiable_tree")
+                    c.execute("RELEASE verifiable_tree")
+                except sqlite3.Error:
+                    # some errors make SQLite roll back the whole
+                    # transaction, savepoint included
+                    try:
+                        c.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        pass
+                self.reload()
+            except Exception:
+                # the error of the block is the one reported; the tree
+                # fails check_root until it is opened again
+                self.root_hash = None
+            raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            c.execute("RELEASE verifiable_tree")
+        finally:
+            self.in_transaction = False
+            c.close()
+            self.local_conn.isolation_level = isolation_level
+
+    def reload(self):
+        """Restores the counter, root hash and root of the tree from
+        verifiable_trees, dropping the cached nodes, after a rolled
+        back transaction."""
+        c = self.local_conn.cursor()
+        c.execute("SELECT root_id, counter, root_hash FROM verifiable_trees WHERE table_name = ?", (self.table_name,))
+        root_id, self.counter, self.root_hash = c.fetchone()
+        c.close()
+        self.writes = None
+        self.load_root(root_id)
+        self.check_root()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Runs the operations of the with block as one batch, see the
+        tree's batch: the root is checked at the start, update_hook
+        runs once per dirty node at the end, the rehashed nodes are
+        written back with one executemany and the root is bumped once.
+        The whole batch is a single transaction, see atomic, so it
+        either commits with the new root or leaves the tree as it was.
+        Range verification is not possible inside a batch."""
+        if self.dirty is not None:
+            yield self
+            return
+
+        self.check_root()
+        with self.atomic():
+            if self.write_back:
+                self.writes = {}
+            try:
+                with super(VerifiableRoot, self).batch():
+                    yield self
+                if self.writes is not None:
+                    self.flush_writes()
+            finally:
+                self.writes = None
+            self.bump_root()
+        self.trim_cache()
+
+    def flush_writes(self):
+        """Writes the rows of the nodes in self.writes, without
+        committing."""
+        raise NotImplementedError
+
+    def get_cache(self):
+        return self._cache
+
+    def set_cache(self, nodes):
+        """Replaces the cached nodes, keeping the budget and counters."""
+        self._cache.clear()
+        for node_id, node in nodes.items():
+            self._cache[node_id] = node
+
+    # the loaded nodes by id, a NodeCache set up by the subclass
+    cache = property(get_cache, set_cache)
+
+    def trim_cache(self):
+        """Evicts nodes past the cache budget, unless a batch is open.
+        The nodes of pinned_ids() are kept, as the tree refers to them;
+        other nodes are only referred to through the cache between
+        operations (a read may still hold some, but never writes)."""
+        if self.dirty is not None or not self._cache.over_budget():
+            return
+        self._cache.trim(self.pinned_ids())
+
+    def pinned_ids(self):
+        """Returns the ids of the cached nodes the tree refers to."""
+        return set([self.root_id()])
+
+    def update(self, row):
+        with self.batch():
+            self.delete(row)
+            self.insert(row)
+
+    def verify(self, resultset, rmin, rmax, include_rmin=True, include_rmax=True):
+        self.check_root()
+
+        compressed_value = self.range_compressed_MAC(rmin, rmax, include_rmin, include_rmax)
+        obtained_value = setmac.compress(self.key2, self.iter_pairs(resultset), backend=self.backend, version=self.kvhash_version)
+        return compressed_value == obtained_value
+
+    def iter_pairs(self, resultset):
+        """Returns an iterator over (row id, field value) pairs of a
+        result set. A Django query set that has been evaluated is read
+        from its result cache, so the pairs checked are those of the
+        rows the caller got. For one never evaluated only these two
+        columns are selected and they are read through the compiler's
+        chunked cursor, so the rows are never all in memory at once."""
+        if not hasattr(resultset, "query") or resultset._result_cache is not None:
+            return ((row.id, getattr(row, self.field_name)) for row in resultset)
+
+        query = resultset.query.clone()
+        query.clear_select_fields()
+        query.add_fields(["id", self.field_name], True)
+        if query.can_filter():
+            # no slicing, so ordering is irrelevant; DISTINCT drops
+            # duplicate rows produced by joins
+            query.clear_ordering(True)
+            query.distinct = True
+        return query.get_compiler(resultset.db).results_iter()
+
+class NodeCache(object):
+    """Cache of the nodes of a tree by id, bounded by a number of nodes
+    and/or an estimate of their bytes (None for no bound). Eviction is
+    CLOCK: nodes are kept in load order, and a node found by get()
+    since it was last passed gets a second chance instead of being
+    evicted.
+
+    Nodes are only evicted by trim(), which the tree calls when no
+    node is dirty and skips the nodes it still refers to, so a row
+    never has two node objects that are written. hits and misses count
+    the lookups by get()."""
+
+    def __init__(self, max_nodes=None, max_bytes=None, sizeof=sys.getsizeof):
+        self.max_nodes, self.max_bytes, self.sizeof = max_nodes, max_bytes, sizeof
+        self.nodes = collections.OrderedDict()
+        self.referenced = set()
+        # estimated bytes of each node when it was cached
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """Returns the node of key, or None if it is not cached."""
+        node = self.nodes.get(key)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.referenced.add(key)
+        return node
+
+    def __getitem__(self, key):
+        return self.nodes[key]
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __setitem__(self, key, node):
+        if key in self.nodes:
+            del self[key]
+        self.nodes[key] = node
+        if self.max_bytes is not None:
+            self.sizes[key] = self.sizeof(node)
+            self.bytes += self.sizes[key]
+
+    def __delitem__(self, key):
+        del self.nodes[key]
+        self.referenced.discard(key)
+        if self.max_bytes is not None:
+            self.bytes -= self.sizes.pop(key)
+
+    def items(self):
+        return self.nodes.items()
+
+    def values(self):
+        return self.nodes.values()
+
+    def clear(self):
+        self.nodes.clear()
+        self.referenced.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+    def over_budget(self):
+        return ((self.max_nodes is not None and len(self.nodes) > self.max_nodes) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes))
+
+    def trim(self, pinned=()):
+        """Evicts nodes until the cache is within budget, except the
+        ids in pinned."""
+        # every node is passed at most twice: once to clear its
+        # reference bit and once to evict it
+        passes = 2 * len(self.nodes)
+        while self.over_budget() and passes:
+            passes -= 1
+            key, node = self.nodes.popitem(last=False)
+            if key in self.referenced or key in pinned:
+                self.referenced.discard(key)
+                self.nodes[key] = node
+            else:
+                if self.max_bytes is not None:
+                    self.bytes -= self.sizes.pop(key)
+                self.evictions += 1
+
+    def stats(self):
+        """Returns the counters and size of the cache, for sizing it
+        against a working set."""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "nodes": len(self.nodes), "bytes": self.bytes if self.max_bytes is not None else None}
+
+class KeyMax(object):
+    """Compares greater than any other value, so (row_key, KEY_MAX)
+    follows every (row_key, row_id) tree key."""
+    def __lt__(self, other):
+        return False
+    def __le__(self, other):
+        return other is self
+    def __gt__(self, other):
+        return other is not self
+    def __ge__(self, other):
+        return True
+    def __eq__(self, other):
+        return other is self
+    def __ne__(self, other):
+        return other is not self
+
+KEY_MAX = KeyMax()
+
+class VerifiableTreeNode(balancedtree.BalancedTreeNode):
+    """Node of a VerifiableTree, stored as the row of row_id. Nodes
+    are augmented with the compressed MAC and the size of their
+    subtree. The node MAC encrypts the compressed MAC XORed with a tag
+    of the size, so sizes are authenticated along with the MACs."""
+    __slots__ = ("row_key", "left_id", "right_id", "tree", "size", "_mac", "_compressed_MAC")
+
+    def __init__(self, row_id, tree, data=None):
+        """Loads the node of row_id, unless its (left, right, row_key,
+        mac, size) columns are given as data."""
+        if data is None:
+            c = tree.conn.cursor()
+            c.execute("SELECT left, right, row_key, mac, size FROM %s WHERE row_id = ?" % tree.table_name, (row_id,))
+            data = c.fetchone()
+            c.close()
         
-        left_id, right_id, self.row_key, self.mac = data
-        self.mac = setmac.unmarshall_MAC(self.mac) if "|" in self.mac else None
+        left_id, right_id, self.row_key, mac, self.size = data
         
         super(VerifiableTreeNode, self).__init__((self.row_key, row_id), row_id)
         
         # constructor overwrote our left and right
         self.left_id = left_id if left_id != -1 else None
         self.right_id = right_id if right_id != -1 else None
+        # the stored size is the weight balancing policies go by
+        if self.size is not None:
+            self.weight = self.size
         
         self.tree = tree
+        self.mac = str(mac) if mac is not None else None
         
         tree.cache[row_id] = self
+
+    def cached_bytes(self):
+        """Estimates the memory held by the node, for cache budgets."""
+        return sys.getsizeof(self) + sys.getsizeof(self.row_key) + 2 * sys.getsizeof(self.mac or "")
     
     def get_left(self):
         if self.left_id:
-            if self.left_id in self.tree.cache:
-                return self.tree.cache[self.left_id]
-            else:
-                return VerifiableTreeNode(self.left_id, self.tree)
+            node = self.tree.cache.get(self.left_id)
+            return node if node is not None else self.tree.fetch(self.left_id)
         else:
             return None
 
     def get_right(self):
         if self.right_id:
-            if self.right_id in self.tree.cache:
-                return self.tree.cache[self.right_id]
-            else:
-                return VerifiableTreeNode(self.right_id, self.tree)
+            node = self.tree.cache.get(self.right_id)
+            return node if node is not None else self.tree.fetch(self.right_id)
         else:
             return None
 
@@ -60,63 +467,109 @@ class VerifiableTreeNode(balancedtree.BalancedTreeNode):
     left = property(get_left, set_left)
     right = property(get_right, set_right)
 
+    def get_mac(self):
+        return self._mac
+
+    def set_mac(self, mac):
+        self._mac = mac
+        self._compressed_MAC = None
+
+    mac = property(get_mac, set_mac)
+
+    def compressed_MAC(self):
+        """Returns the compressed MAC of this node's subtree. It is
+        decrypted from the node MAC on first use and remembered until
+        the node MAC changes."""
+        if self._compressed_MAC is None:
+            self._compressed_MAC = setmac.xor_hashes(setmac.extract_packed_MAC(self.tree.key1, self._mac, self.tree.backend),
+                                                     self.tree.size_tag(self.size))
+        return self._compressed_MAC
+
+    def lsize(self):
+        return self.left.size if self.left else 0
+
+    def rsize(self):
+        return self.right.size if self.right else 0
+
     def verify(self):
-        """Verifies that the MAC stored in this node is correct,
-        assuming that left/right have correct MACs; also verifies the
-        BST property."""
-        mac = setmac.compress(self.tree.key2, {self.value: self.row_key})
+        """Verifies that the MAC and size stored in this node are
+        correct, assuming that left/right have correct MACs; also
+        verifies the BST property."""
+        acc = setmac.XORAccumulator(setmac.kvhash(self.tree.key2, self.value, self.row_key, self.tree.backend, self.tree.kvhash_version))
         
         if self.left:
             assert(self.left.key < self.key)
-            mac = setmac.xor_hashes(mac, setmac.extract_compressed_MAC(self.tree.key1, self.left.mac))
+            acc.add(self.left.compressed_MAC())
             
         if self.right:
             assert(not (self.right.key < self.key))
-            mac = setmac.xor_hashes(mac, setmac.extract_compressed_MAC(self.tree.key1, self.right.mac))
+            acc.add(self.right.compressed_MAC())
 
-        assert(setmac.extract_compressed_MAC(self.tree.key1, self.mac) == mac)
+        assert(self.compressed_MAC() == acc.digest())
+        assert(self.size == 1 + self.lsize() + self.rsize())
 
     def update_hook(self):
         """Rehashes child nodes."""
-        mac = setmac.compress(self.tree.key2, {self.value: self.row_key})
+        acc = setmac.XORAccumulator(setmac.kvhash(self.tree.key2, self.value, self.row_key, self.tree.backend, self.tree.kvhash_version))
 
         if self.left:
-            mac = setmac.xor_hashes(mac, setmac.extract_compressed_MAC(self.tree.key1, self.left.mac))
+            acc.add(self.left.compressed_MAC())
             
         if self.right:
-            mac = setmac.xor_hashes(mac, setmac.extract_compressed_MAC(self.tree.key1, self.right.mac))
+            acc.add(self.right.compressed_MAC())
 
-        self.mac = setmac.encrypt_compressed_MAC(self.tree.key1, mac)
+        compressed = acc.digest()
+        self.size = 1 + self.lsize() + self.rsize()
+        self.mac = setmac.encrypt_packed_MAC(self.tree.key1, setmac.xor_hashes(compressed, self.tree.size_tag(self.size)),
+                                             self.tree.backend)
+        self._compressed_MAC = compressed
 
-        left_id = self.left_id if self.left_id else -1
-        right_id = self.right_id if self.right_id else -1
+        if self.tree.writes is not None:
+            # written back at the end of the batch
+            self.tree.writes[self.value] = self
+            return
 
         c = self.tree.local_conn.cursor()
-        c.execute("UPDATE %s SET left = ?, right = ?, mac = ? WHERE row_id = ?" % self.tree.table_name,
-                  (left_id, right_id,
-                   setmac.marshall_MAC(self.mac), self.value))
-        self.tree.conn.commit()
+        c.execute("UPDATE %s SET left = ?, right = ?, mac = ?, size = ? WHERE row_id = ?" % self.tree.table_name,
+                  self.update_row())
+        if not self.tree.in_transaction:
+            self.tree.conn.commit()
         #self.tree.transaction.commit_unless_managed()
         c.close()
+
+    def update_row(self):
+        """Returns the (left, right, mac, size, row_id) parameters of
+        the UPDATE writing the node."""
+        return (self.left_id or -1, self.right_id or -1, sqlite3.Binary(self.mac), self.size, self.value)
         
 
-class VerifiableTree(balancedtree.BalancedTree):
-    def __init__(self, table_name, field_name, type_name, conn, local_conn, transaction):
+class VerifiableTree(VerifiableRoot, balancedtree.BalancedTree):
+    tree_format = TREE_FORMAT
+
+    def __init__(self, table_name, field_name, type_name, conn, local_conn, transaction, backend=None, policy=None,
+                 fetch_depth=FETCH_DEPTH, cache_nodes=CACHE_NODES, cache_bytes=None):
+        """Opens the tree of the given field, creating it if needed.
+        backend names the setmac digest backend of a new tree (default
+        setmac.DEFAULT_BACKEND). New trees use the current
+        setmac.KVHASH_VERSION; existing trees keep the backend and
+        kvhash version they were created with.
+
+        policy is the balancedtree balancing policy (default AVL). It
+        is not stored: any search tree is valid under every policy, so
+        a field may switch policies. Nodes are loaded fetch_depth
+        levels at a time, see fetch, and kept in a NodeCache of at most
+        cache_nodes nodes and cache_bytes bytes (None for no bound)."""
         self.table_name = '__verifiable_tree__%s__%s' % (table_name, field_name)
         self.field_name = field_name
         self.type_name = type_name
         self.conn = local_conn
         self.local_conn = local_conn
-        self.cache = {}
+        self._cache = NodeCache(cache_nodes, cache_bytes, VerifiableTreeNode.cached_bytes)
         self.transaction = transaction
+        self.fetch_sql = self.make_fetch_sql(fetch_depth)
 
         c = self.conn.cursor()
-        c.execute("""CREATE TABLE IF NOT EXISTS %s
-                     (left INTEGER,
-                     right INTEGER,
-                     row_id INTEGER,
-                     row_key %s,
-                     mac VARCHAR(100))""" % (self.table_name, self.type_name))
+        self.create_table(c, self.table_name)
         self.conn.commit()
         #transaction.commit_unless_managed()
 
@@ -125,10 +578,9 @@ class VerifiableTree(balancedtree.BalancedTree):
             c.execute("SELECT COUNT(*) FROM %s WHERE row_id = ?" % self.table_name, (value,))
             data = c.fetchone()
             if not data[0]:
+                # committed along with the rest of the batch
                 c.execute("INSERT INTO %s (row_id, left, right, mac, row_key) VALUES (?, ?, ?, ?, ?)" % self.table_name,
-                          (value, -1, -1, "empty-before-init", key))
-                self.conn.commit()
-                #transaction.commit_unless_managed()
+                          (value, -1, -1, None, key))
             c.close()
              
             node = VerifiableTreeNode(value, self)
@@ -137,159 +589,840 @@ class VerifiableTree(balancedtree.BalancedTree):
         
         self.vtnfactory = VTNFactory
 
-        super(VerifiableTree, self).__init__(VTNFactory)
+        super(VerifiableTree, self).__init__(VTNFactory, policy)
 
-        c = self.local_conn.cursor()
-        c.execute("""CREATE TABLE IF NOT EXISTS verifiable_trees
-                     (table_name VARCHAR(64) PRIMARY KEY,
-                     key1 CHAR(32),
-                     key2 CHAR(32),
-                     key3 CHAR(32),
-                     root_id INTEGER,
-                     counter INTEGER,
-                     root_hash VARCHAR(1024))""")
-        self.local_conn.commit()
-        
-        c.execute("""SELECT key1, key2, key3, root_id, counter, root_hash
-                     FROM verifiable_trees WHERE table_name = ?""", (self.table_name,))
-        data = c.fetchone()
-        if data:
-            self.key1, self.key2, self.key3, root_id, self.counter, self.root_hash = data
-        else:
-            self.key1 = setmac.rand(32).encode("hex")
-            self.key2 = setmac.rand(32).encode("hex")
-            self.key3 = setmac.rand(32).encode("hex")
-            root_id = -1
-            self.counter = 1
-            self.root = None
-            self.recompute_root_hash()
-            c.execute("""INSERT INTO verifiable_trees
-                         (table_name,
-                         key1,
-                         key2,
-                         key3,
-                         root_id,
-                         counter,
-                         root_hash) VALUES (?, ?, ?, ?, ?, ?, ?)""", (self.table_name, self.key1, self.key2, self. key3, root_id, self.counter, self.root_hash))
-            self.local_conn.commit()
-        
-        c.close()
-        
-        if root_id != -1:
-            self.root = VerifiableTreeNode(root_id, self)
+        root_id, tree_format = self.open_metadata(backend)
+        if tree_format < 2:
+            self.migrate_text_format(root_id)
+        if tree_format < 3:
+            self.migrate_sizes(root_id)
+        if tree_format < 4:
+            self.migrate_keyed()
 
+        self.load_root(root_id)
         self.check_root()
 
-    def check_root(self):
-        computed_hash = setmac.kvhash(self.key3, self.counter, None if not self.root else self.root.mac).encode("hex")
-        assert(computed_hash == self.root_hash)
+    def load_root(self, root_id):
+        """Drops the cached nodes and the fingers and loads the root
+        node of root_id."""
+        self.cache = {}
+        self.fingers.clear()
+        self.root = self.fetch(root_id) if root_id != -1 else None
 
-    def recompute_root_hash(self):
-        self.root_hash = setmac.kvhash(self.key3, self.counter, None if not self.root else self.root.mac).encode("hex")
+    def make_fetch_sql(self, depth):
+        """Returns the statement selecting the nodes of the top depth
+        levels of the subtree of :row_id. Each level is selected by a
+        subquery on the ids of the level above, so a descent takes one
+        round trip per depth levels instead of one per level."""
+        levels = ["SELECT :row_id"]
+        for i in xrange(1, depth):
+            levels.append("SELECT c.row_id FROM %s AS p, %s AS c WHERE p.row_id IN (%s) AND c.row_id IN (p.left, p.right)" %
+                          (self.table_name, self.table_name, levels[-1]))
+        return "SELECT row_id, left, right, row_key, mac, size FROM %s WHERE row_id IN (%s)" % (self.table_name, " UNION ALL ".join(levels))
 
-    def bump_root(self):
-        self.counter += 1
-        self.recompute_root_hash()
+    def fetch(self, row_id):
+        """Loads and returns the node of row_id, loading the nodes of
+        the levels below it (see make_fetch_sql) into the cache on the
+        way. Cached nodes are kept, so there is a single node object per
+        row."""
+        self.trim_cache()
+        c = self.conn.cursor()
+        c.execute(self.fetch_sql, {"row_id": row_id})
+        rows = c.fetchall()
+        c.close()
+        for row in rows:
+            if row[0] not in self.cache:
+                VerifiableTreeNode(row[0], self, row[1:])
+        return self.cache[row_id]
+
+    def pinned_ids(self):
+        """Returns the ids of the root and the finger nodes."""
+        pinned = set(node.value for spine in self.fingers.values() for node in spine)
+        if self.root:
+            pinned.add(self.root.value)
+        return pinned
+
+    def root_id(self):
+        return self.root.value if self.root else -1
 
-        root_id = self.root.value if self.root else -1
+    def root_mac(self):
+        return self.root.mac if self.root else None
 
+    def size_tag(self, size):
+        """Returns the tag XORed into the node MAC of a subtree of the
+        given size."""
+        return setmac.H(self.key3, "size" + setmac.encode_value(size), self.backend)
+
+    def create_table(self, c, table_name):
+        """Creates a tree table in the current format, unless it
+        already exists, and its row key index."""
+        # row_id is the rowid of the table, so the node lookups by row
+        # id (see fetch) need no separate index
+        c.execute("""CREATE TABLE IF NOT EXISTS %s
+                     (row_id INTEGER PRIMARY KEY,
+                     left INTEGER,
+                     right INTEGER,
+                     row_key %s,
+                     mac BLOB,
+                     size INTEGER)""" % (table_name, self.type_name))
+        # format 4 indexes row_key for lookups of rows by field value
+        # in SQL; the tree's own statements all go by row_id
+        c.execute("CREATE INDEX IF NOT EXISTS %s__row_key ON %s (row_key)" % (table_name, table_name))
+
+    def migrate_text_format(self, root_id):
+        """Converts a format 1 tree table to format 2, replacing hex
+        "nonce|ciphertext" MACs by packed BLOBs, and recomputes
+        root_hash for the packed root MAC. The stored root_hash is
+        checked against the old representation first. Runs in a single
+        transaction, so an interrupted migration is simply redone."""
+        def unmarshall(mac):
+            # format 1 root hashes were computed over a tuple of str
+            if mac is None or "|" not in mac:
+                return None
+            return tuple(str(m) for m in setmac.unmarshall_MAC(mac))
+
+        isolation_level = self.local_conn.isolation_level
+        self.local_conn.isolation_level = None
         c = self.local_conn.cursor()
-        c.execute("UPDATE verifiable_trees SET root_id = ?, counter = ?, root_hash = ? WHERE table_name = ?", (root_id, self.counter, self.root_hash, self.table_name))
-        self.local_conn.commit()
-        c.close()
+        c.execute("BEGIN")
+        try:
+            old_table = self.table_name + "__format1"
+            # the index would go along with the renamed table
+            c.execute("DROP INDEX IF EXISTS %s__row_key" % self.table_name)
+            c.execute("ALTER TABLE %s RENAME TO %s" % (self.table_name, old_table))
+            self.create_table(c, self.table_name)
+
+            root_mac = None
+            rows = []
+            for left, right, row_id, row_key, mac in c.execute("SELECT left, right, row_id, row_key, mac FROM %s" % old_table).fetchall():
+                mac = unmarshall(mac)
+                if row_id == root_id:
+                    root_mac = mac
+                rows.append((left, right, row_id, row_key,
+                             sqlite3.Binary(setmac.pack_MAC(mac)) if mac else None))
+
+            assert(setmac.kvhash(self.key3, self.counter, root_mac, self.backend, self.kvhash_version).encode("hex") == self.root_hash)
+
+            c.executemany("INSERT INTO %s (left, right, row_id, row_key, mac) VALUES (?, ?, ?, ?, ?)" % self.table_name, rows)
+            c.execute("DROP TABLE %s" % old_table)
+
+            root_mac = setmac.pack_MAC(root_mac) if root_mac else None
+            self.root_hash = setmac.kvhash(self.key3, self.counter, root_mac, self.backend, self.kvhash_version).encode("hex")
+            c.execute("UPDATE verifiable_trees SET root_hash = ?, format = 2 WHERE table_name = ?",
+                      (self.root_hash, self.table_name))
+            c.execute("COMMIT")
+        except:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            c.close()
+            self.local_conn.isolation_level = isolation_level
+
+    def migrate_sizes(self, root_id):
+        """Converts a format 2 tree table to format 3: adds subtree
+        sizes and re-encrypts every node MAC with its size tag. The
+        whole old tree is verified against root_hash first, so nothing
+        unauthenticated gets rehashed. Runs in a single transaction."""
+        isolation_level = self.local_conn.isolation_level
+        self.local_conn.isolation_level = None
+        c = self.local_conn.cursor()
+        c.execute("BEGIN")
+        try:
+            c.execute("PRAGMA table_info(%s)" % self.table_name)
+            if "size" not in [column[1] for column in c.fetchall()]:
+                c.execute("ALTER TABLE %s ADD COLUMN size INTEGER" % self.table_name)
+
+            nodes = {}
+            for left, right, row_id, row_key, mac in c.execute("SELECT left, right, row_id, row_key, mac FROM %s" % self.table_name).fetchall():
+                nodes[row_id] = (left, right, row_key, str(mac) if mac is not None else None)
+
+            root_mac = nodes[root_id][3] if root_id != -1 else None
+            assert(setmac.kvhash(self.key3, self.counter, root_mac, self.backend, self.kvhash_version).encode("hex") == self.root_hash)
+
+            # post-order walk computing (compressed MAC, size) of every
+            # subtree and checking it against the old node MACs
+            summaries = {}
+            rows = []
+            stack = [(root_id, False)] if root_id != -1 else []
+            while stack:
+                row_id, expanded = stack.pop()
+                left, right, row_key, mac = nodes[row_id]
+                if not expanded:
+                    stack.append((row_id, True))
+                    stack.extend((child, False) for child in (left, right) if child != -1)
+                    continue
+
+                acc = setmac.XORAccumulator(setmac.kvhash(self.key2, row_id, row_key, self.backend, self.kvhash_version))
+                size = 1
+                for child in (left, right):
+                    if child != -1:
+                        acc.add(summaries[child][0])
+                        size += summaries[child][1]
+                compressed = acc.digest()
+                assert(setmac.extract_packed_MAC(self.key1, mac, self.backend) == compressed)
+
+                summaries[row_id] = (compressed, size)
+                mac = setmac.encrypt_packed_MAC(self.key1, setmac.xor_hashes(compressed, self.size_tag(size)), self.backend)
+                rows.append((sqlite3.Binary(mac), size, row_id))
+                if row_id == root_id:
+                    root_mac = mac
+            assert(len(rows) == len(nodes))
+
+            c.executemany("UPDATE %s SET mac = ?, size = ? WHERE row_id = ?" % self.table_name, rows)
+
+            self.root_hash = setmac.kvhash(self.key3, self.counter, root_mac, self.backend, self.kvhash_version).encode("hex")
+            c.execute("UPDATE verifiable_trees SET root_hash = ?, format = 3 WHERE table_name = ?",
+                      (self.root_hash, self.table_name))
+            c.execute("COMMIT")
+        except:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            c.close()
+            self.local_conn.isolation_level = isolation_level
+
+    def migrate_keyed(self):
+        """Converts a format 3 tree table to format 4, keyed by row_id
+        with an index on row_key. The old table is renamed and its rows
+        are moved to a new table MIGRATE_CHUNK rows per transaction, so
+        an interrupted migration carries on where it stopped the next
+        time the tree is opened. The rows are moved unchanged, so the
+        root hash stays valid."""
+        old_table = self.table_name + "__format3"
+        isolation_level = self.local_conn.isolation_level
+        self.local_conn.isolation_level = None
+        c = self.local_conn.cursor()
+        # an interrupted migration left the old table behind; tables
+        # rebuilt by migrate_text_format are keyed already
+        c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (old_table,))
+        moving = c.fetchone()[0] > 0
+        c.execute("PRAGMA table_info(%s)" % self.table_name)
+        keyed = "row_id" in [column[1] for column in c.fetchall() if column[5]]
+        try:
+            if not keyed:
+                c.execute("BEGIN")
+                # the index would go along with the renamed table
+                c.execute("DROP INDEX IF EXISTS %s__row_key" % self.table_name)
+                c.execute("ALTER TABLE %s RENAME TO %s" % (self.table_name, old_table))
+                self.create_table(c, self.table_name)
+                c.execute("COMMIT")
+                moving = True
+
+            while moving:
+                c.execute("BEGIN")
+                c.execute("SELECT MAX(rowid) FROM (SELECT rowid FROM %s ORDER BY rowid LIMIT ?)" % old_table, (MIGRATE_CHUNK,))
+                (last,) = c.fetchone()
+                if last is None:
+                    c.execute("DROP TABLE %s" % old_table)
+                    moving = False
+                else:
+                    c.execute("""INSERT INTO %s (row_id, left, right, row_key, mac, size)
+                                 SELECT row_id, left, right, row_key, mac, size FROM %s WHERE rowid <= ?""" % (self.table_name, old_table),
+                              (last,))
+                    c.execute("DELETE FROM %s WHERE rowid <= ?" % old_table, (last,))
+                c.execute("COMMIT")
+
+            c.execute("BEGIN")
+            c.execute("UPDATE verifiable_trees SET format = 4 WHERE table_name = ?", (self.table_name,))
+            c.execute("COMMIT")
+        except:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            c.close()
+            self.local_conn.isolation_level = isolation_level
 
     def insert(self, row):
-        self.check_root()
-        super(VerifiableTree, self).insert(getattr(row, self.field_name), row.id)
-        self.bump_root()
+        with self.batch():
+            super(VerifiableTree, self).insert(getattr(row, self.field_name), row.id)
         
     def delete(self, row):
-        self.check_root()
+        with self.batch():
+            c = self.conn.cursor()
+            c.execute("SELECT row_key FROM %s WHERE row_id = ?" % self.table_name, (row.id,))
+            (row_key,) = c.fetchone()
+            c.close()
 
-        c = self.conn.cursor()
-        c.execute("SELECT row_key FROM %s WHERE row_id = ?" % self.table_name, (row.id,))
-        (row_key,) = c.fetchone()
-        self.conn.commit()
-        #transaction.commit_unless_managed()        
-        c.close()        
-        
-        super(VerifiableTree, self).delete((row_key, row.id))
+            super(VerifiableTree, self).delete((row_key, row.id))
 
+            c = self.conn.cursor()
+            c.execute("DELETE FROM %s WHERE row_id = ?" % self.table_name, (row.id,))
+            c.close()
+            if self.writes is not None:
+                self.writes.pop(row.id, None)
+
+    def flush_writes(self):
+        """Writes the rows of the nodes in self.writes with a single
+        UPDATE executemany, without committing."""
         c = self.conn.cursor()
-        c.execute("DELETE FROM %s WHERE row_id = ?" % self.table_name, (row.id,))
-        self.conn.commit()
-        #transaction.commit_unless_managed()        
+        c.executemany("UPDATE %s SET left = ?, right = ?, mac = ?, size = ? WHERE row_id = ?" % self.table_name,
+                      (node.update_row() for node in self.writes.itervalues()))
         c.close()
+        self.writes.clear()
 
-        self.bump_root()
+    def build(self, rows):
+        """Fills an empty tree with rows (model instances or a query
+        set, see iter_pairs) in O(n) hook work: all nodes are written
+        with bulk statements in a single transaction and the root is
+        bumped once."""
+        self.check_root()
+        assert(not self.root)
 
-    def update(self, row):
-        self.delete(row)
-        self.insert(row)
+        # on failure atomic rolls back to the empty tree
+        with self.atomic():
+            c = self.conn.cursor()
+            c.execute("DELETE FROM %s" % self.table_name)
+            c.executemany("INSERT INTO %s (row_id, left, right, mac, row_key) VALUES (?, -1, -1, NULL, ?)" % self.table_name,
+                          self.iter_pairs(rows))
+            # read the keys back, so nodes hash the same values as
+            # when they are loaded later on
+            c.execute("SELECT row_id, row_key FROM %s" % self.table_name)
+            items = sorted(((row_key, row_id), row_id) for row_id, row_key in c.fetchall())
+            c.close()
 
-    def verify(self, resultset, rmin, rmax, include_rmin=True, include_rmax=True):
-        self.check_root()
+            def factory(key, row_id):
+                return VerifiableTreeNode(row_id, self, (-1, -1, key[0], None, 1))
+
+            self.writes = {}
+            try:
+                self.build_from_sorted(items, factory)
+                self.flush_writes()
+            finally:
+                self.writes = None
+            self.bump_root()
+        self.trim_cache()
+
+    def delete_range(self, rmin, rmax, include_rmin=True, include_rmax=True):
+        """Deletes the elements of a range (None for an open end) and
+        returns their number. The tree is split at both ends of the
+        range and the outer parts are joined again, so only O(log n)
+        nodes are rehashed and written. The rows are deleted by the row
+        ids of the subtree split off, with a DELETE ... IN statement
+        per DELETE_CHUNK rows, rather than by comparing row_key in SQL,
+        whose collations, affinities and NULL handling need not agree
+        with the order of the tree."""
+        # tree keys are (row_key, row_id); the range is lo <= key < hi
+        lo = None if rmin is None else (rmin,) if include_rmin else (rmin, KEY_MAX)
+        hi = None if rmax is None else (rmax, KEY_MAX) if include_rmax else (rmax,)
+
+        with self.batch():
+            left, middle = None, self.root
+            if lo is not None:
+                left, middle = self.split(lo)
+            right = None
+            if hi is not None:
+                self.root = middle
+                middle, right = self.split(hi)
+            self.join(left, right)
+
+            row_ids, stack = [], [middle] if middle else []
+            while stack:
+                node = stack.pop()
+                row_ids.append(node.value)
+                stack.extend(child for child in (node.left, node.right) if child)
+
+            # one statement per DELETE_CHUNK rows
+            c = self.conn.cursor()
+            for i in xrange(0, len(row_ids), DELETE_CHUNK):
+                chunk = row_ids[i:i + DELETE_CHUNK]
+                c.execute("DELETE FROM %s WHERE row_id IN (%s)" % (self.table_name, ", ".join("?" * len(chunk))), chunk)
+                # a node without its row: the batch rolls back
+                assert(c.rowcount == len(chunk))
+            c.close()
+
+            for row_id in row_ids:
+                if row_id in self.cache:
+                    del self.cache[row_id]
+
+        return len(row_ids)
 
-        compressed_value = self.range_compressed_MAC(rmin, rmax, include_rmin, include_rmax)
-        obtained_value = setmac.compress(self.key2, dict([(row.id, getattr(row, self.field_name)) for row in resultset]))
-        return compressed_value == obtained_value
-    
     def range_compressed_MAC(self, rmin, rmax, include_rmin=True, include_rmax=True):
         """Get compressed MAC for a range, verifying elements past the
         end of range."""
+        return self.range_summary(rmin, rmax, include_rmin, include_rmax)[0]
 
-        if not self.root:
+    def range_count(self, rmin, rmax, include_rmin=True, include_rmax=True):
+        """Returns the verified number of elements in a range, taken
+        from the same two descents as range_compressed_MAC."""
+        self.check_root()
+
+        first, stop = self.range_positions(rmin, rmax, include_rmin, include_rmax)
+        return max(0, stop - first)
+
+    def verify_slice(self, resultset, rmin, rmax, start, stop, include_rmin=True, include_rmax=True):
+        """Like verify, for the elements start:stop of the range in
+        (row_key, row_id) order; start and stop are Python slice
+        bounds."""
+        self.check_root()
+
+        compressed_value = self.slice_compressed_MAC(rmin, rmax, start, stop, include_rmin, include_rmax)
+        obtained_value = setmac.compress(self.key2, self.iter_pairs(resultset), backend=self.backend, version=self.kvhash_version)
+        return compressed_value == obtained_value
+
+    def slice_compressed_MAC(self, rmin, rmax, start, stop, include_rmin=True, include_rmax=True):
+        """Get compressed MAC for the elements start:stop of a range,
+        by their in-order positions in the tree."""
+        first, end = self.range_positions(rmin, rmax, include_rmin, include_rmax)
+        start, stop, step = slice(start, stop).indices(max(0, end - first))
+        lo, hi = first + start, first + stop
+        if lo >= hi:
             return setmac.empty_compressed_MAC
-        
-        m_all = setmac.extract_compressed_MAC(self.key1, self.root.mac)
-        
-        if rmin:
-            m_left = setmac.empty_compressed_MAC
-            # invariant: after each iteration we still need to search
-            # in t for the least value satisfying rmin constraint
-            
-            t = self.root
-            
-            while t:
-                t.verify()
 
-                if t.row_key < rmin or (t.row_key == rmin and not include_rmin):
-                    # neither t nor t.left need to be included in the
-                    # results, min satisfying is in t.right
-                    t = t.right
-                else:
-                    # t and t.right needs to be included in the
-                    # results. min satisfying is in t.left
-                    m_left = setmac.xor_hashes(m_left, setmac.extract_compressed_MAC(self.key1, t.mac))
-                    if t.left:
-                        m_left = setmac.xor_hashes(m_left, setmac.extract_compressed_MAC(self.key1, t.left.mac))
+        m_all = self.root.compressed_MAC()
+        m_left = self.edge_summary(lambda t, position: position < lo, False)[0]
+        m_right = self.edge_summary(lambda t, position: position >= hi, True)[0]
+        m_left.merge(m_right)
+        m_left.add(m_all)
+        return m_left.digest()
 
-                    t = t.left
+    def range_positions(self, rmin, rmax, include_rmin=True, include_rmax=True):
+        """Returns the in-order positions (first, stop) of a range: the
+        range holds the elements first, ..., stop - 1."""
+        return self.range_summary(rmin, rmax, include_rmin, include_rmax)[1:]
+
+    def range_summary(self, rmin, rmax, include_rmin=True, include_rmax=True):
+        """Returns the compressed MAC of a range and its in-order
+        positions (first, stop), see range_positions."""
+        if not self.root:
+            return setmac.empty_compressed_MAC, 0, 0
+
+        # the root MAC binds the root size through its size tag, but it
+        # is only checked by verifying the root, which an open end does
+        # not descend through
+        self.root.verify()
+        m_all = self.root.compressed_MAC()
+        n_all = self.root.size
+
+        if rmin is not None:
+            def outside(t, position):
+                return t.row_key < rmin or (t.row_key == rmin and not include_rmin)
+            m_left, n_left = self.edge_summary(outside, False)
         else:
-            m_left = m_all
+            m_left, n_left = setmac.XORAccumulator(m_all), n_all
 
-        if rmax:
-            m_right = setmac.empty_compressed_MAC
-            # invariant: after each iteration we still need to search
-            # in t for the greatest value satisfying rmax constraint
-            
-            t = self.root
-            
-            while t:
-                t.verify()
+        if rmax is not None:
+            def outside(t, position):
+                return t.row_key > rmax or (t.row_key == rmax and not include_rmax)
+            m_right, n_right = self.edge_summary(outside, True)
+        else:
+            m_right, n_right = setmac.XORAccumulator(m_all), n_all
 
-                if t.row_key > rmax or (t.row_key == rmax and not include_rmax):
-                    # neither t nor t.right need to be included in the
-                    # results, max satisfying is in t.left
+        m_left.merge(m_right)
+        m_left.add(m_all)
+        return m_left.digest(), n_all - n_left, n_right
+
+    def edge_summary(self, outside, upper):
+        """Descends to one end of a range, verifying the nodes on the
+        way. Returns an accumulator of the compressed MACs of, and the
+        number of, all elements not past that end: the elements for
+        which outside is false, a suffix of the tree for the lower end
+        and a prefix for the upper end. outside(t, position) is given
+        node t and its in-order position."""
+        acc = setmac.XORAccumulator()
+        count = 0
+        # invariant: after each iteration we still need to search in t,
+        # whose subtree starts at position base, for the end element
+        t = self.root
+        base = 0
+        while t:
+            t.verify()
+            position = base + t.lsize()
+
+            if not upper:
+                if outside(t, position):
+                    # neither t nor t.left are included, the end
+                    # element is in t.right
+                    base = position + 1
+                    t = t.right
+                else:
+                    # t and t.right are included, the end element is
+                    # in t.left
+                    acc.add(t.compressed_MAC())
+                    count += t.size
+                    if t.left:
+                        acc.add(t.left.compressed_MAC())
+                        count -= t.left.size
+                    t = t.left
+            else:
+                if outside(t, position):
+                    # neither t nor t.right are included, the end
+                    # element is in t.left
                     t = t.left
                 else:
-                    # t and t.left needs to be included in the
-                    # results. max satisfying is in t.right
-                    m_right = setmac.xor_hashes(m_right, setmac.extract_compressed_MAC(self.key1, t.mac))
+                    # t and t.left are included, the end element is in
+                    # t.right
+                    acc.add(t.compressed_MAC())
+                    count += t.size
                     if t.right:
-                        m_right = setmac.xor_hashes(m_right, setmac.extract_compressed_MAC(self.key1, t.right.mac))
+                        acc.add(t.right.compressed_MAC())
+                        count -= t.right.size
+                    base = position + 1
                     t = t.right
+        return acc, count
+
+def btree_key(v):
+    """Returns a field value as VerifiableBTree stores it in its JSON
+    keys. Values are converted the way SQLite stores them in a tree
+    table, so they still encode the same under setmac.encode_value."""
+    if isinstance(v, bool):
+        return int(v)
+    elif isinstance(v, decimal.Decimal):
+        return int(v) if v == v.to_integral_value() else float(v)
+    elif isinstance(v, str):
+        return v.decode("utf-8")
+    elif isinstance(v, datetime.datetime):
+        return v.isoformat(" ")
+    elif isinstance(v, (datetime.date, datetime.time)):
+        return v.isoformat()
+    return v
+
+class VerifiableBTreeNode(bplustree.BPlusTreeNode):
+    """Node of a VerifiableBTree, stored as a single row. Leaves hold
+    (row_key, row_id) keys. Internal nodes hold a handle per child:
+
+        (child id, packed MAC, compressed MAC, lower bound, upper bound)
+
+    The packed MAC encrypts the compressed MAC of the child's subtree
+    XORed with a tag of the separators bounding the child, so the
+    separators are authenticated along with the child. Only ids and
+    packed MACs are stored; compressed MACs are decrypted on load.
+
+    self.compressed is the compressed MAC of the node's subtree as
+    given by the parent handle (or the root hash for the root); the
+    node's own contents are checked against it by verify()."""
+    __slots__ = ("node_id", "tree", "compressed", "verified", "hashes")
+
+    def __init__(self, node_id, tree, data=None):
+        """Loads node node_id, unless its (leaf, keys, children, macs)
+        columns are given as data."""
+        if data is None:
+            c = tree.conn.cursor()
+            c.execute("SELECT leaf, keys, children, macs FROM %s WHERE node_id = ?" % tree.table_name, (node_id,))
+            data = c.fetchone()
+            c.close()
+
+        leaf, keys, children, macs = data
+
+        super(VerifiableBTreeNode, self).__init__(bool(leaf))
+
+        self.node_id = node_id
+        self.tree = tree
+        self.compressed = None
+        self.verified = False
+        # kvhash of each key of a leaf
+        self.hashes = {}
+
+        self.keys = [tuple(key) for key in json.loads(keys)]
+        if self.leaf:
+            self.values = [row_id for row_key, row_id in self.keys]
         else:
-            m_right = m_all
-        
-        return setmac.xor_hashes(m_all, setmac.xor_hashes(m_left, m_right))
+            macs = str(macs)
+            n = setmac.PACKED_MACLEN
+            for i, child_id in enumerate(json.loads(children)):
+                mac = macs[i*n:(i+1)*n]
+                lo, hi = self.bounds(i)
+                compressed = setmac.xor_hashes(setmac.extract_packed_MAC(tree.key1, mac, tree.backend),
+                                               tree.bound_tag(lo, hi))
+                self.children.append((child_id, mac, compressed, lo, hi))
+
+        tree.cache[node_id] = self
+
+    def cached_bytes(self):
+        """Estimates the memory held by the node, for cache budgets."""
+        return (sys.getsizeof(self) + sys.getsizeof(self.keys) + sys.getsizeof(self.children) +
+                sum(sys.getsizeof(key[0]) for key in self.keys) +
+                len(self.children) * (setmac.PACKED_MACLEN + setmac.MACLEN))
+
+    def bounds(self, i):
+        """Returns the separators bounding child i, None standing for
+        the bound of this node itself."""
+        return (self.keys[i-1] if i > 0 else None,
+                self.keys[i] if i < len(self.keys) else None)
+
+    def handle(self):
+        # the MAC is filled in by the parent's update_hook
+        return (self.node_id, None, self.compressed, None, None)
+
+    def get_child(self, i):
+        child_id, mac, compressed = self.children[i][:3]
+        node = self.tree.cache.get(child_id)
+        if node is not None:
+            return node
+        self.tree.trim_cache()
+        node = VerifiableBTreeNode(child_id, self.tree)
+        node.compressed = compressed
+        return node
+
+    def digest(self):
+        """Computes the compressed MAC of the subtree from the node's
+        contents: the kvhashes of a leaf's keys, or the compressed
+        MACs of an internal node's children."""
+        acc = setmac.XORAccumulator()
+        if self.leaf:
+            self.hashes = {}
+            for key in self.keys:
+                self.hashes[key] = self.tree.key_hash(key)
+                acc.add(self.hashes[key])
+        else:
+            for handle in self.children:
+                acc.add(handle[2])
+        return acc.digest()
+
+    def verify(self):
+        """Verifies that the node's contents match its compressed MAC,
+        once per load; also verifies the order of its keys."""
+        if self.verified:
+            return
+        for a, b in zip(self.keys, self.keys[1:]):
+            assert(a < b)
+        assert(self.digest() == self.compressed)
+        self.verified = True
+
+    def update_hook(self):
+        """Rehashes the node, re-encrypting the handles of children
+        whose compressed MAC or bounds changed, and writes it back."""
+        tree = self.tree
+        acc = setmac.XORAccumulator()
+        if self.leaf:
+            hashes = {}
+            for key in self.keys:
+                hashes[key] = self.hashes.get(key) or tree.key_hash(key)
+                acc.add(hashes[key])
+            self.hashes = hashes
+        else:
+            children = []
+            for i, (child_id, mac, compressed, lo, hi) in enumerate(self.children):
+                if child_id in tree.cache:
+                    child_compressed = tree.cache[child_id].compressed
+                else:
+                    child_compressed = compressed
+                bounds = self.bounds(i)
+                if mac is None or child_compressed != compressed or bounds != (lo, hi):
+                    mac = setmac.encrypt_packed_MAC(tree.key1,
+                                                    setmac.xor_hashes(child_compressed, tree.bound_tag(*bounds)),
+                                                    tree.backend)
+                children.append((child_id, mac, child_compressed) + bounds)
+                acc.add(child_compressed)
+            self.children = children
+
+        self.compressed = acc.digest()
+        self.verified = True
+
+        if tree.writes is not None:
+            # written back at the end of the batch
+            tree.writes[self.node_id] = self
+            return
+
+        c = tree.local_conn.cursor()
+        c.execute("INSERT OR REPLACE INTO %s (node_id, leaf, keys, children, macs) VALUES (?, ?, ?, ?, ?)" % tree.table_name,
+                  self.row())
+        if not tree.in_transaction:
+            tree.conn.commit()
+        c.close()
+
+    def remove_hook(self):
+        tree = self.tree
+        del tree.cache[self.node_id]
+
+        c = tree.local_conn.cursor()
+        c.execute("DELETE FROM %s WHERE node_id = ?" % tree.table_name, (self.node_id,))
+        if tree.writes is not None:
+            tree.writes.pop(self.node_id, None)
+        elif not tree.in_transaction:
+            tree.conn.commit()
+        c.close()
+
+    def row(self):
+        """Returns the (node_id, leaf, keys, children, macs) columns of
+        the node."""
+        return (self.node_id, int(self.leaf), json.dumps(self.keys),
+                json.dumps([handle[0] for handle in self.children]),
+                sqlite3.Binary("".join(handle[1] for handle in self.children)))
+
+class VerifiableBTree(VerifiableRoot, bplustree.BPlusTree):
+    """Verifiable tree in B+-tree layout: a node holds up to fanout
+    keys or children in a single row, with one packed MAC per child,
+    so a descent loads log_fanout(n) rows instead of log_2(n). Same
+    interface as VerifiableTree."""
+    tree_format = BTREE_FORMAT
+
+    def __init__(self, table_name, field_name, type_name, conn, local_conn, transaction, backend=None, fanout=bplustree.DEFAULT_FANOUT,
+                 cache_nodes=CACHE_NODES, cache_bytes=None):
+        """Opens the B-tree of the given field, creating it with the
+        given fanout if needed; existing trees keep the fanout, backend
+        and kvhash version they were created with. Row ids are mapped
+        to their keys by a second, unauthenticated table used to find
+        rows to delete. Loaded nodes are kept in a NodeCache of at
+        most cache_nodes nodes and cache_bytes bytes, as for
+        VerifiableTree."""
+        self.table_name = '__verifiable_btree__%s__%s' % (table_name, field_name)
+        self.keys_table = self.table_name + '__keys'
+        self.field_name = field_name
+        self.type_name = type_name
+        self.conn = local_conn
+        self.local_conn = local_conn
+        self._cache = NodeCache(cache_nodes, cache_bytes, VerifiableBTreeNode.cached_bytes)
+        self.transaction = transaction
+
+        c = self.conn.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS %s
+                     (node_id INTEGER PRIMARY KEY,
+                     leaf INTEGER,
+                     keys TEXT,
+                     children TEXT,
+                     macs BLOB)""" % self.table_name)
+        c.execute("""CREATE TABLE IF NOT EXISTS %s
+                     (row_id INTEGER PRIMARY KEY,
+                     row_key TEXT)""" % self.keys_table)
+        c.execute("SELECT MAX(node_id) FROM %s" % self.table_name)
+        self.next_id = (c.fetchone()[0] or 0) + 1
+        self.conn.commit()
+        c.close()
+
+        def VBTNFactory(leaf):
+            node = VerifiableBTreeNode(self.next_id, self, (leaf, "[]", "[]", ""))
+            self.next_id += 1
+            return node
+
+        super(VerifiableBTree, self).__init__(VBTNFactory, fanout)
+
+        root_id, tree_format = self.open_metadata(backend)
+
+        self.load_root(root_id)
+        self.check_root()
+
+    def load_root(self, root_id):
+        """Drops the cached nodes and loads the root node of root_id."""
+        self.cache = {}
+        self.root = None
+        if root_id != -1:
+            self.root = VerifiableBTreeNode(root_id, self)
+            # authenticated by the root hash
+            self.root.compressed = self.root.digest()
+            self.root.verified = True
+
+    def root_id(self):
+        return self.root.node_id if self.root else -1
+
+    def root_mac(self):
+        return self.root.compressed if self.root else None
+
+    def key_hash(self, key):
+        row_key, row_id = key
+        return setmac.kvhash(self.key2, row_id, row_key, self.backend, self.kvhash_version)
+
+    def bound_tag(self, lo, hi):
+        """Returns the tag of the (lo, hi) separator pair, either of
+        which may be None."""
+        s = "".join(setmac.encode_value(v) for bound in (lo, hi) for v in (bound or (None, None)))
+        return setmac.H(self.key3, s, self.backend)
+
+    def insert(self, row):
+        key = (btree_key(getattr(row, self.field_name)), row.id)
+        with self.batch():
+            c = self.conn.cursor()
+            c.execute("INSERT INTO %s (row_id, row_key) VALUES (?, ?)" % self.keys_table, (row.id, json.dumps(key[0])))
+            c.close()
+
+            super(VerifiableBTree, self).insert(key, row.id)
+
+    def delete(self, row):
+        with self.batch():
+            c = self.conn.cursor()
+            c.execute("SELECT row_key FROM %s WHERE row_id = ?" % self.keys_table, (row.id,))
+            (row_key,) = c.fetchone()
+            c.execute("DELETE FROM %s WHERE row_id = ?" % self.keys_table, (row.id,))
+            c.close()
+
+            super(VerifiableBTree, self).delete((json.loads(row_key), row.id))
+
+    def flush_writes(self):
+        """Writes the rows of the nodes in self.writes with a single
+        INSERT OR REPLACE executemany, without committing."""
+        c = self.conn.cursor()
+        c.executemany("INSERT OR REPLACE INTO %s (node_id, leaf, keys, children, macs) VALUES (?, ?, ?, ?, ?)" % self.table_name,
+                      (node.row() for node in self.writes.itervalues()))
+        c.close()
+        self.writes.clear()
+
+    def build(self, rows):
+        """Fills an empty tree with rows (model instances or a query
+        set, see iter_pairs), writing all nodes with bulk statements in
+        a single transaction."""
+        self.check_root()
+        assert(not self.root)
+
+        items = sorted(((btree_key(row_key), row_id), row_id) for row_id, row_key in self.iter_pairs(rows))
+
+        # on failure atomic rolls back to the empty tree
+        with self.atomic():
+            c = self.conn.cursor()
+            c.execute("DELETE FROM %s" % self.keys_table)
+            c.executemany("INSERT INTO %s (row_id, row_key) VALUES (?, ?)" % self.keys_table,
+                          ((row_id, json.dumps(key[0])) for key, row_id in items))
+            c.execute("DELETE FROM %s" % self.table_name)
+            c.close()
+            self.writes = {}
+            try:
+                self.build_from_sorted(items)
+                self.flush_writes()
+            finally:
+                self.writes = None
+            self.bump_root()
+
+    def range_compressed_MAC(self, rmin, rmax, include_rmin=True, include_rmax=True):
+        """Get compressed MAC for a range, verifying the nodes on the
+        paths to both ends of the range. Children entirely inside the
+        range contribute the compressed MAC of their handle without
+        being loaded."""
+        if not self.root:
+            return setmac.empty_compressed_MAC
+
+        m_all = self.root.compressed
+
+        if rmin is not None:
+            rmin = btree_key(rmin)
+            def outside(key):
+                return key[0] < rmin or (key[0] == rmin and not include_rmin)
+            m_left = self.edge_compressed_MAC(outside, False)
+        else:
+            m_left = setmac.XORAccumulator(m_all)
+
+        if rmax is not None:
+            rmax = btree_key(rmax)
+            def outside(key):
+                return key[0] > rmax or (key[0] == rmax and not include_rmax)
+            m_right = self.edge_compressed_MAC(outside, True)
+        else:
+            m_right = setmac.XORAccumulator(m_all)
+
+        m_left.merge(m_right)
+        m_left.add(m_all)
+        return m_left.digest()
+
+    def edge_compressed_MAC(self, outside, upper):
+        """Returns an accumulator of the compressed MACs of all keys
+        not outside the range at one end: the keys for which outside is
+        false form a suffix of the tree for the lower end, a prefix for
+        the upper end."""
+        acc = setmac.XORAccumulator()
+        t = self.root
+        while True:
+            t.verify()
+            if t.leaf:
+                for key in t.keys:
+                    if not outside(key):
+                        acc.add(t.hashes[key])
+                return acc
+
+            # children before i lie below separator i - 1, after i
+            # above separator i
+            if not upper:
+                i = len([key for key in t.keys if outside(key)])
+                inside = t.children[i+1:]
+            else:
+                i = len([key for key in t.keys if not outside(key)])
+                inside = t.children[:i]
+            for handle in inside:
+                acc.add(handle[2])
+            t = t.get_child(i)